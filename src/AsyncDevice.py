@@ -0,0 +1,228 @@
+import asyncio
+import threading
+import time
+from BAC0.core.io.IOExceptions import UnrecognizedService, SegmentationNotSupported
+from BAC0.core.io.Read import find_reason
+from bacpypes.apdu import ReadPropertyRequest, ReadPropertyACK, ReadPropertyMultipleRequest, ReadPropertyMultipleACK, \
+    ReadAccessSpecification
+from bacpypes.basetypes import PropertyReference
+from bacpypes.core import deferred
+from bacpypes.iocb import IOCB
+from bacpypes.object import get_datatype
+from bacpypes.pdu import Address
+from src.Device import Device
+
+
+class AsyncDevice(Device):
+    '''
+    Device with an asyncio backend. Reads and writes are coroutines on an event loop running in a background thread:
+    the batches of one read and the single writes of one step are sent together instead of one after the other,
+    at most max_concurrent_requests at a time per device, and every request has a timeout and is retried.
+    The blocking read_data / write_values of Device run the coroutines on the loop and can be called from several
+    threads: Test writes the ramp / periodic updates of a tick from a worker thread while it reads the capture sample
+    and the condition, and all of them share the same limit.
+    '''
+    def __init__(self, device_config, network=None, rate_limiter=None, refresh_cache=False, metrics=None):
+        '''
+        :param device_config: device section of the config, see Device; also max_concurrent_requests,
+                              request_timeout (seconds) and request_retries
+        '''
+        self.max_concurrent_requests = device_config.get("max_concurrent_requests", 4)
+        self.request_timeout = device_config.get("request_timeout", 10)
+        self.request_retries = device_config.get("request_retries", 2)
+
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, name="AsyncDevice %s" % device_config["device_id"],
+                                            daemon=True)
+        self.loop_thread.start()
+        self.semaphore = self.run(self.create_semaphore())
+
+        super().__init__(device_config=device_config, network=network, rate_limiter=rate_limiter, refresh_cache=refresh_cache,
+                         metrics=metrics)
+
+    async def create_semaphore(self):
+        # created on the loop it is used on
+        return asyncio.Semaphore(self.max_concurrent_requests)
+
+    def run(self, coroutine):
+        # run a coroutine on the device's loop and wait for its result, from any other thread
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+
+    async def throttle_async(self):
+        if self.rate_limiter is not None:
+            await self.loop.run_in_executor(None, self.throttle)
+
+    async def send(self, request):
+        '''
+        Send one request through the BACnet stack and wait for its answer, or abort it after request_timeout seconds
+        :return: the completed IOCB, with ioError TimeoutError if the device did not answer
+        '''
+        future = self.loop.create_future()
+
+        def on_complete(iocb):
+            # called from the BACnet thread
+            self.loop.call_soon_threadsafe(lambda: future.done() or future.set_result(iocb))
+
+        request.pduDestination = Address(str(self.device_address))
+        iocb = IOCB(request)
+        iocb.add_callback(on_complete)
+        start_time = time.perf_counter()
+        deferred(self.bacnet.this_application.request_io, iocb)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.request_timeout)
+        except asyncio.TimeoutError:
+            deferred(iocb.abort, TimeoutError("no answer from device %s within %s seconds" % (self.device_id, self.request_timeout)))
+            await future
+        iocb.elapsed = time.perf_counter() - start_time
+        return iocb
+
+    async def request(self, request):
+        '''
+        Send a request, retrying it up to request_retries times if the device does not answer
+        :return: the completed IOCB, with elapsed set to the round trip time of the last attempt
+        '''
+        for attempt in range(self.request_retries + 1):
+            await self.throttle_async()
+            async with self.semaphore:
+                iocb = await self.send(request)
+            if not isinstance(iocb.ioError, TimeoutError):
+                return iocb
+            print("device %s: %s (attempt %d of %d)" % (self.device_id, iocb.ioError, attempt + 1, self.request_retries + 1))
+            # a new transaction needs a new invoke id
+            request.apduInvokeID = None
+        return iocb
+
+    def request_io(self, request):
+        # writes and COV subscriptions of Device also get the timeout, the retries and the concurrency limit
+        return self.run(self.request(request))
+
+    def decode_value(self, obj_type, property_value):
+        return property_value.cast_out(get_datatype(obj_type, 'presentValue'))
+
+    async def read_point(self, point_name):
+        '''
+        :return: presentValue of a point
+        '''
+        obj_type, obj_inst = self.object_ids[point_name]
+        iocb = await self.request(ReadPropertyRequest(objectIdentifier=(obj_type, int(obj_inst)), propertyIdentifier='presentValue'))
+        self.metrics.observe('read_seconds', iocb.elapsed, label=point_name)
+        if iocb.ioError is not None or not isinstance(iocb.ioResponse, ReadPropertyACK):
+            raise Exception("failed to read %s from device %s: %s" % (point_name, self.device_id, self.get_reason(iocb)))
+        return self.decode_value(obj_type, iocb.ioResponse.propertyValue)
+
+    async def read_multiple(self, points):
+        '''
+        Read the presentValue of several points with one ReadPropertyMultiple request
+        :return: dictionary of bacnet point name: value, without the points the device returned an error for
+        '''
+        specs = []
+        for point in points:
+            obj_type, obj_inst = self.object_ids[point]
+            specs.append(ReadAccessSpecification(objectIdentifier=(obj_type, int(obj_inst)),
+                                                 listOfPropertyReferences=[PropertyReference(propertyIdentifier='presentValue')]))
+        iocb = await self.request(ReadPropertyMultipleRequest(listOfReadAccessSpecs=specs))
+        self.metrics.observe_points('read_seconds', iocb.elapsed, points)
+
+        if iocb.ioError is not None:
+            reason = self.get_reason(iocb)
+            if reason == 'unrecognizedService':
+                raise UnrecognizedService()
+            if reason == 'segmentationNotSupported':
+                raise SegmentationNotSupported()
+            return {}
+        if not isinstance(iocb.ioResponse, ReadPropertyMultipleACK):
+            return {}
+
+        values = {}
+        for point, result in zip(points, iocb.ioResponse.listOfReadAccessResults):
+            for element in result.listOfResults:
+                if element.readResult.propertyAccessError is None:
+                    values[point] = self.decode_value(result.objectIdentifier[0], element.readResult.propertyValue)
+        return values
+
+    def get_reason(self, iocb):
+        if isinstance(iocb.ioError, Exception):
+            return str(iocb.ioError)
+        try:
+            return find_reason(iocb.ioError)
+        except (AttributeError, ValueError):
+            return str(iocb.ioError)
+
+    async def read_points(self, points_to_read):
+        '''
+        Read values of requested points, all ReadPropertyMultiple batches at once
+        :param points_to_read: list of point names
+        :return: dictionary of pointname: value
+        '''
+        points_to_read = list(dict.fromkeys(points_to_read))
+        values = {}
+
+        if self.rpm_supported:
+            batches = self.get_rpm_batches(points_to_read)
+            results = await asyncio.gather(*[self.read_multiple(batch) for batch in batches], return_exceptions=True)
+            for result in results:
+                if isinstance(result, (UnrecognizedService, SegmentationNotSupported)):
+                    if self.rpm_supported:
+                        print("device %s rejected ReadPropertyMultiple, falling back to single reads" % self.device_id)
+                    self.rpm_supported = False
+                elif isinstance(result, Exception):
+                    raise result
+                else:
+                    values.update(result)
+
+        # points not answered by ReadPropertyMultiple
+        missing = [point for point in points_to_read if values.get(point) is None]
+        values.update(zip(missing, await asyncio.gather(*[self.read_point(point) for point in missing])))
+        return values
+
+    def read_data(self, points_to_read):
+        return self.run(self.read_points(points_to_read))
+
+    async def write_point(self, point_name, properties):
+        requests = self.get_write_requests(point_name, properties)
+        if requests is None:
+            return False
+        # the properties of one point, e.g. outOfService then presentValue, are written in order
+        for request in requests:
+            if not self.check_write_response(await self.request(request), point_name):
+                return False
+        return True
+
+    async def write_multiple(self, writes):
+        request = self.get_wpm_request(writes)
+        if request is None:
+            return False
+        return self.check_wpm_response(await self.request(request), writes)
+
+    async def write_points(self, point_value_dict, priority=None):
+        '''
+        Write the presentValue of several points at once, see Device.write_values
+        :return: dictionary of bacnet point name: True if the write succeeded
+        '''
+        if priority is None:
+            priority = self.write_priority
+        writes = {point: self.get_write_properties(point, point_value_dict[point], priority) for point in point_value_dict}
+        results = {}
+
+        if self.wpm_supported:
+            batches = self.get_batches(list(writes), self.WPM_HEADER_SIZE, self.WPM_BYTES_PER_POINT)
+            successes = await asyncio.gather(*[self.write_multiple({point: writes[point] for point in batch}) for batch in batches])
+            for batch, success in zip(batches, successes):
+                if success:
+                    results.update({point: True for point in batch})
+
+        # points not written by WritePropertyMultiple, e.g. after an error in their batch
+        remaining = [point for point in writes if point not in results]
+        results.update(zip(remaining, await asyncio.gather(*[self.write_point(point, writes[point]) for point in remaining])))
+
+        for point in writes:
+            if results[point]:
+                self.update_out_of_service(point, writes[point])
+        return results
+
+    def write_values(self, point_value_dict, priority=None):
+        return self.run(self.write_points(point_value_dict, priority=priority))
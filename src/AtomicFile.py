@@ -0,0 +1,25 @@
+import os
+import tempfile
+
+# mkstemp creates files readable by the owner only, the files get the permissions of a plain open() instead
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def write_atomic(filename, data):
+    '''
+    Write a file through a temporary file in the same folder, so that an interrupted run never leaves a broken file.
+    The temporary file has a unique name: tests running in parallel may write the same file at the same time.
+    :param data: str or bytes
+    '''
+    folder, base = os.path.split(filename)
+    fd, tmp_filename = tempfile.mkstemp(dir=folder or ".", prefix=base + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb" if isinstance(data, bytes) else "w") as fp:
+            fp.write(data)
+        os.chmod(tmp_filename, 0o666 & ~UMASK)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
@@ -0,0 +1,319 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import numpy as np
+import openpyxl
+import pandas as pd
+import yaml
+from src.Test import Test
+from src.TestPlan import Condition
+
+
+class Benchmark:
+    '''
+    Reproducible benchmark of the hot paths of Test and of the device I/O. Runs against a SimulatedDevice with
+    injected request latency, on generated test scripts of several sizes and on real test scripts with their point
+    maps, saves latency percentiles and throughput to json and compares them against a baseline run.
+    '''
+    FILE_FOLDER = "./files/"
+    WORK_FOLDER = "benchmark/"
+
+    def __init__(self, sizes=((10, 10), (50, 50)), repeat=100, latency=0.002, point_latency=0.0001, batch_size=20,
+                 poll_interval=0.05, scripts=(), headers=None):
+        '''
+        :param sizes: list of (number of input / output point pairs, number of steps) of the generated scripts
+        :param scripts: list of (test script, point map) in files/ to benchmark on a simulated device with the points of the map
+        :param headers: input_points_header, conditions_header and output_points_header of the scripts, the defaults of Test if None
+        :param repeat: number of timed runs of each case, device I/O and condition cases run less often
+        :param latency: simulated seconds per request
+        :param point_latency: simulated seconds per point of a request
+        :param batch_size: points per simulated request
+        :param poll_interval: condition poll interval in seconds
+        '''
+        self.sizes = sizes
+        self.repeat = repeat
+        self.latency = latency
+        self.point_latency = point_latency
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.scripts = scripts
+        self.headers = headers or {}
+        self.folder = self.FILE_FOLDER + self.WORK_FOLDER
+        self.results = {}
+
+    def get_meta(self):
+        return {'time': time.strftime("%Y-%m-%d %H:%M:%S"), 'python': platform.python_version(), 'machine': platform.machine(),
+                'sizes': ["%dx%d" % size for size in self.sizes], 'scripts': [script for script, point_map in self.scripts],
+                'repeat': self.repeat, 'latency': self.latency,
+                'point_latency': self.point_latency, 'batch_size': self.batch_size, 'poll_interval': self.poll_interval}
+
+    def write_script(self, points, steps, filename):
+        # test script in the layout of the spreadsheets: section, description, variable, bounds, then one column per step
+        rows = [["Simulation (controller) Inputs", None, None, None] + [None] * steps]
+        for i in range(points):
+            if i == 1:
+                values = ["=In0*2"] * steps
+            elif i == 2:
+                values = ["ramp(0;%d;60;1)" % (j + 1) for j in range(steps)]
+            else:
+                values = [50 + i + j for j in range(steps)]
+            rows.append([None, "input", "In%d" % i, None] + values)
+
+        rows.append(["Result Time", None, None, None] + [None] * steps)
+        rows.append([None, "time", "ClkTime", None] + ["00:00:01"] * steps)
+        rows.append([None, "condition", "or", None] + [0] * steps)
+        rows.append([None, "condition", "VariableName", None] + [None] * steps)
+        rows.append([None, "condition", "VariableValue", None] + [None] * steps)
+
+        rows.append(["Expected Controller BACnet Outputs", None, None, None] + [None] * steps)
+        for i in range(points):
+            if i % 2:
+                values = ["=In%d+1" % i] * steps
+            else:
+                values = ["Any"] * steps
+            rows.append([None, "output", "Out%d" % i, 0.5] + values)
+
+        # written with openpyxl to store "=..." cells as text, like the scripts do, instead of as formulas
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        for row in rows:
+            sheet.append(row)
+        for row in sheet.iter_rows():
+            for cell in row:
+                if type(cell.value) == str and cell.value.startswith("="):
+                    cell.data_type = 's'
+        workbook.save(filename)
+
+    def make_test(self, points, steps):
+        '''
+        Write the point map, script and config of one size and create a Test on them
+        '''
+        os.makedirs(self.folder, exist_ok=True)
+        size = "%dx%d" % (points, steps)
+        map_file = self.WORK_FOLDER + "map_%s.json" % size
+        script_file = self.WORK_FOLDER + "script_%s.xlsx" % size
+        config_file = "config_%s.yaml" % size
+
+        mapping = {}
+        for i in range(points):
+            mapping["In%d" % i] = "AV_IN_%d" % i
+            mapping["Out%d" % i] = "AV_OUT_%d" % i
+        with open(self.FILE_FOLDER + map_file, "w") as fp:
+            json.dump(mapping, fp, indent=2)
+        self.write_script(points=points, steps=steps, filename=self.FILE_FOLDER + script_file)
+
+        models = [{'model': 'ExpressionModel', 'output': "AV_OUT_%d" % i, 'expression': "AV_IN_%d+1" % i} for i in range(points)]
+        return self.create_test(script_file=script_file, map_file=map_file, config_file=config_file, models=models)
+
+    def make_script_test(self, script_file, map_file):
+        '''
+        Create a Test on a test script and point map of files/, the simulated device has all points of the map
+        '''
+        os.makedirs(self.folder, exist_ok=True)
+        config_file = "config_%s.yaml" % self.get_script_name(script_file)
+        return self.create_test(script_file=script_file, map_file=map_file, config_file=config_file, headers=self.headers)
+
+    def create_test(self, script_file, map_file, config_file, models=(), headers=None):
+        config = {
+            'device': {'simulated': True, 'device_address': 'benchmark', 'device_id': 0, 'latency': self.latency,
+                       'point_latency': self.point_latency, 'batch_size': self.batch_size, 'models': list(models)},
+            'test': dict({'test_script': script_file, 'point_map': map_file, 'condition_poll_interval': self.poll_interval,
+                          'clock': 'monotonic'}, **(headers or {})),
+        }
+        with open(self.folder + config_file, "w") as fp:
+            yaml.safe_dump(config, fp)
+
+        # config files are read from src/
+        return Test(config_file="../" + self.folder[2:] + config_file)
+
+    def get_script_name(self, script_file):
+        return os.path.splitext(os.path.basename(script_file))[0]
+
+    def measure(self, name, function, repeat):
+        durations = []
+        for i in range(repeat):
+            start_time = time.perf_counter()
+            function()
+            durations.append(time.perf_counter() - start_time)
+        self.record(name, durations)
+
+    def record(self, name, durations):
+        durations = np.array(durations)
+        self.results[name] = {'count': len(durations), 'mean': float(durations.mean()),
+                              'p50': float(np.percentile(durations, 50)), 'p90': float(np.percentile(durations, 90)),
+                              'p99': float(np.percentile(durations, 99)), 'max': float(durations.max()),
+                              'throughput': float(len(durations) / durations.sum()) if durations.sum() > 0 else None}
+
+    def measure_condition_latency(self, name, test, input_point, output_point, repeat):
+        # time from the write that satisfies a condition on output_point until test_conditions returns
+        condition = Condition(clk_time=10, variable=output_point, operator=">=", value=100)
+        durations = []
+        for i in range(repeat):
+            test.controller.write_values({input_point: 0})
+            test.overrides.clear()
+            change = {}
+
+            def satisfy():
+                change['time'] = time.perf_counter()
+                test.controller.write_values({input_point: 200})
+
+            timer = threading.Timer(self.poll_interval * (1 + (i % 7) / 7.0), satisfy)
+            timer.start()
+            test.test_conditions(condition=condition, st=test.clock.monotonic())
+            detected = time.perf_counter()
+            timer.join()
+            durations.append(detected - change['time'])
+        self.record(name, durations)
+
+    def run_size(self, points, steps):
+        test = self.make_test(points=points, steps=steps)
+        self.run_cases(test=test, label="%dx%d" % (points, steps), input_point=test.registry.to_bacnet("In0"),
+                       output_point=test.registry.to_bacnet("Out0"))
+
+    def run_script(self, script_file, map_file):
+        test = self.make_script_test(script_file=script_file, map_file=map_file)
+        # without models the condition waits for the written input itself
+        input_point = test.plan.input_points[0]
+        self.run_cases(test=test, label=self.get_script_name(script_file), input_point=input_point, output_point=input_point)
+
+    def run_cases(self, test, label, input_point, output_point):
+        '''
+        Time all cases on a Test, the case names end with /<label>
+        :param input_point: point written to satisfy the condition of the condition latency case
+        :param output_point: point of that condition
+        '''
+        slow_repeat = max(5, self.repeat // 10)
+
+        def load_script(use_cache):
+            test.init_test_sequence(filename=test.test_file, ip_header=test.input_points_header, cond_header=test.conditions_header,
+                                    op_header=test.output_points_header, registry=test.registry, use_cache=use_cache)
+        self.measure("load_script/%s" % label, lambda: load_script(use_cache=False), repeat=slow_repeat)
+        # the Test already saved the plan cache when it was created
+        self.measure("load_script_cached/%s" % label, lambda: load_script(use_cache=True), repeat=slow_repeat)
+        test_df = pd.read_excel(test.FILE_FOLDER + test.test_file, index_col=0, header=None)
+        positions = {header: i for i, header in enumerate(test_df.index) if header in (test.input_points_header, test.conditions_header)}
+        ip_df = test_df.iloc[positions[test.input_points_header] + 1:positions[test.conditions_header]]
+        self.measure("format_excel_df/%s" % label, lambda: test.format_excel_df(df=ip_df, registry=test.registry), repeat=self.repeat)
+
+        snapshot = test.controller.read_data(points_to_read=test.registry.names)
+        expression = test.compile_expression("=" + "+".join(test.registry.to_test(point) for point in test.plan.output_points))
+        self.measure("evaluate_expression/%s" % label, lambda: test.evaluate_expression(expression=expression, values=snapshot),
+                     repeat=self.repeat)
+
+        step = test.plan.steps[-1]
+        test.current_step = step.number
+        test.set_values(inputs=step.inputs)
+        outputs = test.controller.read_data(points_to_read=test.plan.output_points)
+        self.measure("assert_output/%s" % label, lambda: test.assert_output(checks=step.outputs, actual_output_dict=outputs),
+                     repeat=self.repeat)
+
+        inputs = list(test.plan.input_points)
+        self.measure("read_all_points/%s" % label, lambda: test.controller.read_data(points_to_read=test.registry.names),
+                     repeat=slow_repeat)
+        self.measure("read_one_point/%s" % label, lambda: test.controller.read_data(points_to_read=inputs[:1]), repeat=slow_repeat)
+        self.measure("write_inputs/%s" % label, lambda: test.controller.write_values({point: 1.0 for point in inputs}),
+                     repeat=slow_repeat)
+
+        self.measure_condition_latency("condition_latency/%s" % label, test, input_point=input_point, output_point=output_point,
+                                       repeat=slow_repeat)
+
+    def run(self):
+        self.results = {}
+        # the test engine prints every step, keep the benchmark output readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            for points, steps in self.sizes:
+                self.run_size(points=points, steps=steps)
+            for script_file, map_file in self.scripts:
+                self.run_script(script_file=script_file, map_file=map_file)
+        return {'meta': self.get_meta(), 'results': self.results}
+
+    def print_results(self, results, baseline=None):
+        print("%-32s %10s %10s %10s %12s %12s" % ("case", "p50 ms", "p90 ms", "p99 ms", "ops/s", "p50 change"))
+        for name, result in results['results'].items():
+            change = ""
+            if baseline is not None and name in baseline['results'] and baseline['results'][name]['p50'] > 0:
+                change = "%+.1f %%" % ((result['p50'] / baseline['results'][name]['p50'] - 1) * 100)
+            print("%-32s %10.3f %10.3f %10.3f %12.1f %12s" % (name, result['p50'] * 1000, result['p90'] * 1000, result['p99'] * 1000,
+                                                             result['throughput'] or 0, change))
+
+
+def compare(results, baseline, tolerance=0.2):
+    '''
+    :param tolerance: allowed relative increase of the p50 and p90 latencies
+    :return: list of (case, percentile, baseline value, value) of the regressions
+    '''
+    regressions = []
+    for name, result in results['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        for percentile in ('p50', 'p90'):
+            if result[percentile] > base[percentile] * (1 + tolerance):
+                regressions.append((name, percentile, base[percentile], result[percentile]))
+    return regressions
+
+
+def parse_sizes(text):
+    return [tuple(int(n) for n in size.split("x")) for size in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", help="comma separated <points>x<steps> script sizes, 10x10,50x50 unless --script is given")
+    parser.add_argument("--script", help="test script in files/ to benchmark, with --point-map", action='append', default=[])
+    parser.add_argument("--point-map", help="point map in files/ of each --script", action='append', default=[])
+    parser.add_argument("--config", help="config file in src/ with the section headers of the scripts", default="config.yaml")
+    parser.add_argument("--repeat", help="timed runs per case", type=int, default=100)
+    parser.add_argument("--latency", help="simulated seconds per request", type=float, default=0.002)
+    parser.add_argument("--point-latency", help="simulated seconds per point of a request", type=float, default=0.0001)
+    parser.add_argument("--batch-size", help="points per simulated request", type=int, default=20)
+    parser.add_argument("--poll-interval", help="condition poll interval in seconds", type=float, default=0.05)
+    parser.add_argument("--name", help="result name", default=time.strftime("%Y%m%dT%H%M%S"))
+    parser.add_argument("--baseline", help="result json to compare against")
+    parser.add_argument("--tolerance", help="allowed relative slowdown against the baseline", type=float, default=0.2)
+
+    args = parser.parse_args()
+    if len(args.script) != len(args.point_map):
+        parser.error("every --script needs a --point-map")
+    sizes = args.sizes or ("" if args.script else "10x10,50x50")
+
+    # real scripts use the section headers of the test section of the config
+    headers = {}
+    if args.script and os.path.exists("./src/" + args.config):
+        with open("./src/" + args.config, "r") as fp:
+            test_config = (yaml.safe_load(fp) or {}).get("test") or {}
+        headers = {key: test_config[key] for key in ('input_points_header', 'conditions_header', 'output_points_header')
+                   if test_config.get(key)}
+
+    benchmark = Benchmark(sizes=parse_sizes(sizes) if sizes else [], repeat=args.repeat, latency=args.latency,
+                          point_latency=args.point_latency, batch_size=args.batch_size, poll_interval=args.poll_interval,
+                          scripts=list(zip(args.script, args.point_map)), headers=headers)
+    results = benchmark.run()
+
+    filename = benchmark.folder + args.name + ".json"
+    with open(filename, "w") as fp:
+        json.dump(results, fp, indent=2)
+    print("results saved to %s" % filename)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as fp:
+            baseline = json.load(fp)
+        different = [key for key in ('sizes', 'scripts', 'repeat', 'latency', 'point_latency', 'batch_size', 'poll_interval')
+                     if key in baseline['meta'] and baseline['meta'][key] != results['meta'][key]]
+        if different:
+            print("WARNING: the baseline was run with different %s" % ", ".join(different))
+    benchmark.print_results(results, baseline=baseline)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, tolerance=args.tolerance)
+        for name, percentile, base, value in regressions:
+            print("REGRESSION %s %s: %.3f ms -> %.3f ms" % (name, percentile, base * 1000, value * 1000))
+        if regressions:
+            sys.exit(1)
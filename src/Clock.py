@@ -0,0 +1,149 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+
+
+class Clock(ABC):
+    '''
+    Clock interface used by Test for all timing.
+    time() gives wall clock timestamps for logs, monotonic() is used for intervals and deadlines,
+    sleep() and wait() block for a duration measured on this clock.
+    '''
+    @abstractmethod
+    def time(self):
+        pass
+
+    @abstractmethod
+    def monotonic(self):
+        pass
+
+    @abstractmethod
+    def sleep(self, seconds):
+        pass
+
+    @abstractmethod
+    def wait(self, event, timeout):
+        '''
+        Wait until the event is set or the timeout has passed
+        :return: True if the event is set
+        '''
+        pass
+
+
+class RealTimeClock(Clock):
+    '''
+    Wall clock for timestamps and intervals alike, intervals follow system clock adjustments.
+    '''
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def wait(self, event, timeout):
+        return event.wait(timeout=max(0, timeout))
+
+
+class MonotonicClock(RealTimeClock):
+    '''
+    Wall clock timestamps, intervals and deadlines on time.monotonic(). Default clock for real controllers.
+    '''
+    def monotonic(self):
+        return time.monotonic()
+
+
+class AcceleratedClock(Clock):
+    '''
+    Clock running speedup times faster than real time, for controllers or simulations that run accelerated.
+    Sleeps and waits block for 1/speedup of the requested duration.
+    '''
+    def __init__(self, speedup, start_time=None):
+        self.speedup = float(speedup)
+        self.start_time = time.time() if start_time is None else start_time
+        self.real_start = time.monotonic()
+
+    def time(self):
+        return self.start_time + self.monotonic()
+
+    def monotonic(self):
+        return (time.monotonic() - self.real_start) * self.speedup
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.speedup)
+
+    def wait(self, event, timeout):
+        return event.wait(timeout=max(0, timeout) / self.speedup)
+
+
+class VirtualClock(Clock):
+    '''
+    Stepped simulated clock: sleeping and waiting advance the clock instantly instead of blocking,
+    so runs against a SimulatedDevice take as long as the computation does.
+    '''
+    def __init__(self, start_time=None):
+        self.start_time = time.time() if start_time is None else start_time
+        self.elapsed = 0.0
+        self.lock = threading.Lock()
+
+    def time(self):
+        return self.start_time + self.elapsed
+
+    def monotonic(self):
+        return self.elapsed
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            with self.lock:
+                self.elapsed += seconds
+
+    def wait(self, event, timeout):
+        if event.is_set():
+            return True
+        self.sleep(timeout)
+        return event.is_set()
+
+
+def get_clock(name=None, speedup=None):
+    '''
+    :param name: real, monotonic (default), accelerated or virtual
+    :param speedup: speedup of the accelerated clock
+    '''
+    if name is None or name == "monotonic":
+        return MonotonicClock()
+    elif name == "real":
+        return RealTimeClock()
+    elif name == "accelerated":
+        return AcceleratedClock(speedup=speedup or 1)
+    elif name == "virtual":
+        return VirtualClock()
+    raise Exception("unknown clock %s" % name)
+
+
+class PeriodicDeadline:
+    '''
+    Deadline repeating every period seconds from a start time, on the monotonic clock of a Clock.
+    Ticks missed because the caller was late are not replayed: due() returns the latest tick that has passed.
+    '''
+    def __init__(self, start, period):
+        self.start = start
+        self.period = period
+        self.tick = 0
+
+    @property
+    def next_time(self):
+        return self.start + self.tick * self.period
+
+    def due(self, now):
+        '''
+        :return: index of the latest tick at or before now if it was not returned yet, otherwise None
+        '''
+        if now < self.next_time:
+            return None
+        tick = max(self.tick, int((now - self.start) // self.period))
+        self.tick = tick + 1
+        return tick
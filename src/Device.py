@@ -1,46 +1,443 @@
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
 import BAC0
+from BAC0.core.io.IOExceptions import UnrecognizedService, SegmentationNotSupported
+from bacpypes.apdu import SubscribeCOVRequest, SimpleAckPDU, RejectPDU, WritePropertyRequest, WritePropertyMultipleRequest, \
+    WriteAccessSpecification
+from bacpypes.basetypes import PropertyValue
+from bacpypes.constructeddata import Any
+from bacpypes.core import deferred
+from bacpypes.iocb import IOCB
+from bacpypes.object import get_datatype
+from bacpypes.pdu import Address
+from bacpypes.primitivedata import Null, Real, Unsigned
+from src.DiscoveryCache import DiscoveryCache
+from src.Metrics import Metrics
 
 class Device:
-    def __init__(self, device_config):
+    # bit positions in protocolServicesSupported
+    SERVICE_SUBSCRIBE_COV = 5
+    SERVICE_READ_PROPERTY_MULTIPLE = 14
+    SERVICE_WRITE_PROPERTY_MULTIPLE = 16
+
+    # input objects are written by taking them out of service, like BAC0 does
+    INPUT_TYPES = ('analogInput', 'binaryInput', 'multiStateInput')
+
+    # default max APDU for MS/TP devices, used when the device does not report maxApduLengthAccepted
+    DEFAULT_MAX_APDU = 480
+    # bytes used by the ReadPropertyMultiple ack header
+    RPM_HEADER_SIZE = 16
+    # worst case bytes for one object's presentValue in a ReadPropertyMultiple ack
+    RPM_BYTES_PER_POINT = 24
+    # bytes used by the WritePropertyMultiple request header
+    WPM_HEADER_SIZE = 16
+    # worst case bytes for one object in a WritePropertyMultiple request, outOfService and presentValue with priority
+    WPM_BYTES_PER_POINT = 32
+
+    # COV subscriptions of all devices, keyed by subscriber process id, so that devices sharing one network
+    # also share the notification handler
+    cov_subscriptions = {}
+    cov_process_ids = itertools.count(1)
+
+    CACHE_FOLDER = "./files/cache/"
+
+    def __init__(self, device_config, network=None, rate_limiter=None, refresh_cache=False, metrics=None):
+        '''
+        :param device_config: device section of the config
+        :param network: BAC0 network to use, connects a new one if None
+        :param rate_limiter: RateLimiter of the trunk the device is on, None for no limit
+        :param refresh_cache: discard the cached point properties of the device and discover it again
+        :param metrics: Metrics recording the read and write latencies, not recorded if None
+        '''
         self.device_config = device_config
-        self.init_device(config=self.device_config)
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics or Metrics(enabled=False)
+        self.init_device(config=self.device_config, network=network, refresh_cache=refresh_cache)
 
-    def init_device(self, config):
-        self.network_address = config["network_address"]
+    def init_device(self, config, network=None, refresh_cache=False):
+        self.network_address = config.get("network_address")
         self.device_address = config["device_address"]
         self.device_id = config["device_id"]
 
-        self.bacnet = BAC0.connect(ip=self.network_address)
-        self.device = BAC0.device(address=self.device_address, device_id=self.device_id, network=self.bacnet, poll=5)
-        self.point_properties = self.device.points_properties_df().T
+        if network is None:
+            network = BAC0.connect(ip=self.network_address)
+        self.bacnet = network
+        # seconds between BAC0's background reads of all loaded points; off by default, the test reads the points it uses itself
+        self.poll = config.get("poll", 0)
+        # objects of all point maps used with this device so far, see reset_device
+        self.used_objects = set()
+        self.discover(config=config, refresh_cache=refresh_cache)
+
+        self.max_apdu = config.get("max_apdu") or self.read_max_apdu()
+        self.services_supported = self.read_services_supported()
+        self.rpm_supported = self.supports_service(self.SERVICE_READ_PROPERTY_MULTIPLE)
+        self.wpm_supported = self.supports_service(self.SERVICE_WRITE_PROPERTY_MULTIPLE)
+
+        self.write_priority = config.get("write_priority", 8)
+        self.write_workers = config.get("write_workers", 8)
+        # input objects this test has taken out of service
+        self.out_of_service = set()
+        self.bacnet.this_application.do_UnconfirmedCOVNotificationRequest = Device.do_cov_notification
+
+    def discover(self, config, refresh_cache=False):
+        '''
+        Find the points of the device. With a valid cache entry the point properties come from the cache and only
+        the objects used by the previous test are loaded, instead of walking the whole object list of the device
+        '''
+        start_time = time.monotonic()
+        self.discovery_cache = None
+        if config.get("discovery_cache", True):
+            self.discovery_cache = DiscoveryCache(folder=config.get("cache_folder") or self.CACHE_FOLDER)
+            if refresh_cache:
+                self.discovery_cache.invalidate(device_id=self.device_id, device_address=self.device_address)
+
+        self.revision = None
+        cached = None
+        if self.discovery_cache is not None:
+            self.revision = self.read_revision()
+            cached = self.discovery_cache.load(device_id=self.device_id, device_address=self.device_address, revision=self.revision)
+
+        if cached is not None and cached['object_list'] is not None:
+            self.discovery_source = "cache"
+            self.point_properties = cached['point_properties']
+            self.object_list = cached['object_list']
+            self.device = BAC0.device(address=self.device_address, device_id=self.device_id, network=self.bacnet, poll=self.poll,
+                                      object_list=self.object_list)
+        else:
+            self.discovery_source = "device"
+            self.object_list = None
+            self.device = BAC0.device(address=self.device_address, device_id=self.device_id, network=self.bacnet, poll=self.poll)
+            self.point_properties = self.device.points_properties_df().T
+            if self.discovery_cache is not None:
+                self.discovery_cache.save(device_id=self.device_id, device_address=self.device_address, revision=self.revision,
+                                          point_properties=self.point_properties)
+        self.init_object_ids()
+
+        self.discovery_time = time.monotonic() - start_time
+        print("discovered %d points of device %s from the %s in %.1f seconds" % (
+            len(self.point_properties), self.device_id, self.discovery_source, self.discovery_time))
+
+    def read_revision(self):
+        # databaseRevision changes whenever objects are added, deleted or renamed; not all devices have it
+        try:
+            return "databaseRevision:%s" % int(self.read_device_property("databaseRevision"))
+        except Exception:
+            pass
+        try:
+            return "objects:%s" % int(self.read_device_property("objectList 0"))
+        except Exception:
+            return None
 
     def get_point_properties(self):
+        '''
+        :return: properties of all discovered points, not only of the loaded objects
+        '''
         return self.point_properties
 
     def reset_device(self, object_list):
-        self.device = BAC0.device(address=self.device_address, device_id=self.device_id, network=self.bacnet, poll=5,
+        '''
+        Load the objects of a point map, together with the objects of the point maps used before, so that the
+        scripts of a suite can switch between point maps on the same device
+        '''
+        self.used_objects.update((obj_type, int(instance)) for obj_type, instance in object_list)
+        # the device was loaded, e.g. from the cache, with these objects already
+        if self.object_list is not None and self.used_objects <= set(self.object_list):
+            return
+
+        start_time = time.monotonic()
+        object_list = sorted(self.used_objects)
+        self.device = BAC0.device(address=self.device_address, device_id=self.device_id, network=self.bacnet, poll=self.poll,
                                   object_list=object_list)
-        self.point_properties = self.device.points_properties_df().T
+        self.object_list = object_list
+        if self.discovery_cache is not None:
+            self.discovery_cache.save(device_id=self.device_id, device_address=self.device_address, revision=self.revision,
+                                      point_properties=self.point_properties, object_list=object_list)
+        self.discovery_time += time.monotonic() - start_time
+
+    def init_object_ids(self):
+        self.object_ids = dict(zip(self.point_properties.index, zip(self.point_properties['type'], self.point_properties['address'])))
+
+    def throttle(self):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+    def read_device_property(self, prop):
+        self.throttle()
+        return self.bacnet.read("%s device %s %s" % (self.device_address, self.device_id, prop))
+
+    def read_max_apdu(self):
+        try:
+            max_apdu = int(self.read_device_property("maxApduLengthAccepted"))
+        except Exception:
+            max_apdu = self.DEFAULT_MAX_APDU
+        return max_apdu
+
+    def read_services_supported(self):
+        try:
+            return list(self.read_device_property("protocolServicesSupported"))
+        except Exception:
+            return None
+
+    def supports_service(self, service):
+        # support unknown: let the first request find out
+        if self.services_supported is None:
+            return True
+        return bool(self.services_supported[service])
 
     def read_all_points(self):
         self.points = self.device.points
 
-    def set_values(self, point_value_dict):
-        for key in point_value_dict:
+    def set_values(self, point_value_dict, priority=None):
+        return self.write_values(point_value_dict=point_value_dict, priority=priority)
+
+    def get_batches(self, points, header_size, bytes_per_point):
+        points_per_request = max(1, (self.max_apdu - header_size) // bytes_per_point)
+        return [points[i:i + points_per_request] for i in range(0, len(points), points_per_request)]
+
+    def get_rpm_batches(self, points):
+        return self.get_batches(points, self.RPM_HEADER_SIZE, self.RPM_BYTES_PER_POINT)
+
+    def read_data(self, points_to_read):
+        '''
+        Read values of requested points
+        :param points_to_read: list of point names
+        :return: dictionary of pointname: value
+        '''
+        points_to_read = list(dict.fromkeys(points_to_read))
+        values = {}
+
+        if self.rpm_supported:
+            for batch in self.get_rpm_batches(points_to_read):
+                try:
+                    values.update(self.read_batch(batch))
+                except (UnrecognizedService, SegmentationNotSupported):
+                    print("device %s rejected ReadPropertyMultiple, falling back to single reads" % self.device_id)
+                    self.rpm_supported = False
+                    break
+
+        for point in points_to_read:
+            if values.get(point) is None:
+                values[point] = self.read_single_point(point)
+        return values
+
+    def read_batch(self, points):
+        request = [str(self.device_address)]
+        for point in points:
+            obj_type, obj_inst = self.object_ids[point]
+            request.append("%s %s presentValue" % (obj_type, obj_inst))
+
+        self.throttle()
+        start_time = time.perf_counter()
+        result = self.bacnet.readMultiple(" ".join(request))
+        self.metrics.observe_points('read_seconds', time.perf_counter() - start_time, points)
+
+        # no response or a short answer: leave these points to single reads
+        if result is None or len(result) != len(points):
+            return {}
+        return dict(zip(points, result))
+
+    def read_single_point(self, point_name):
+        obj_type, obj_inst = self.object_ids[point_name]
+        self.throttle()
+        start_time = time.perf_counter()
+        value = self.bacnet.read("%s %s %s presentValue" % (self.device_address, obj_type, obj_inst))
+        self.metrics.observe('read_seconds', time.perf_counter() - start_time, label=point_name)
+        return value
+
+    def subscribe_cov(self, point_name, callback, lifetime=None):
+        '''
+        Subscribe to unconfirmed COV notifications of a point's presentValue
+        :param point_name: bacnet point name
+        :param callback: called as callback(point_name, value) from the BACnet thread on every notification
+        :param lifetime: subscription lifetime in seconds, None for indefinite
+        :return: True if the device accepted the subscription
+        '''
+        if not self.supports_service(self.SERVICE_SUBSCRIBE_COV):
+            return False
+
+        process_id = next(Device.cov_process_ids)
+
+        obj_type, obj_inst = self.object_ids[point_name]
+        request = SubscribeCOVRequest(subscriberProcessIdentifier=process_id,
+                                      monitoredObjectIdentifier=(obj_type, int(obj_inst)),
+                                      issueConfirmedNotifications=False, lifetime=lifetime)
+        Device.cov_subscriptions[process_id] = (self, point_name, callback)
+        if not self.send_request(request):
+            del Device.cov_subscriptions[process_id]
+            return False
+        return True
+
+    def unsubscribe_cov(self, point_name):
+        for process_id, (device, name, callback) in list(Device.cov_subscriptions.items()):
+            if device is not self or name != point_name:
+                continue
+            obj_type, obj_inst = self.object_ids[point_name]
+            # a subscription request without lifetime and notification type cancels the subscription
+            request = SubscribeCOVRequest(subscriberProcessIdentifier=process_id,
+                                          monitoredObjectIdentifier=(obj_type, int(obj_inst)))
+            self.send_request(request)
+            del Device.cov_subscriptions[process_id]
+
+    def request_io(self, request):
+        request.pduDestination = Address(str(self.device_address))
+        iocb = IOCB(request)
+        self.throttle()
+        start_time = time.perf_counter()
+        deferred(self.bacnet.this_application.request_io, iocb)
+        iocb.wait()
+        # round trip time, without the wait for the rate limiter
+        iocb.elapsed = time.perf_counter() - start_time
+        return iocb
+
+    def send_request(self, request):
+        iocb = self.request_io(request)
+        return iocb.ioError is None and isinstance(iocb.ioResponse, SimpleAckPDU)
+
+    @staticmethod
+    def do_cov_notification(apdu):
+        subscription = Device.cov_subscriptions.get(apdu.subscriberProcessIdentifier)
+        if subscription is None:
+            return
+        device, point_name, callback = subscription
+        obj_type = apdu.monitoredObjectIdentifier[0]
+        for element in apdu.listOfValues:
+            if element.propertyIdentifier == 'presentValue':
+                value = element.value.cast_out(get_datatype(obj_type, 'presentValue'))
+                callback(point_name, value)
+
+    def set_single_point(self, point_name, value, priority=None):
+        return self.write_values(point_value_dict={point_name: value}, priority=priority)[point_name]
+
+    def write_values(self, point_value_dict, priority=None):
+        '''
+        Write the presentValue of several points at once, with WritePropertyMultiple if the device supports it,
+        otherwise with concurrent single writes
+        :param point_value_dict: dictionary of bacnet point name: value, None or 'null' relinquishes the point
+        :param priority: BACnet priority 1-16 of the writes, write_priority of the config (default 8) if None
+        :return: dictionary of bacnet point name: True if the write succeeded
+        '''
+        if priority is None:
+            priority = self.write_priority
+        writes = {point: self.get_write_properties(point, point_value_dict[point], priority) for point in point_value_dict}
+        results = {}
+
+        if self.wpm_supported:
+            for batch in self.get_batches(list(writes), self.WPM_HEADER_SIZE, self.WPM_BYTES_PER_POINT):
+                if not self.wpm_supported:
+                    break
+                if self.write_batch({point: writes[point] for point in batch}):
+                    results.update({point: True for point in batch})
+
+        # points not written by WritePropertyMultiple, e.g. after an error in their batch
+        remaining = [point for point in writes if point not in results]
+        if len(remaining) == 1:
+            results[remaining[0]] = self.write_single_point(remaining[0], writes[remaining[0]])
+        elif remaining:
+            with ThreadPoolExecutor(max_workers=self.write_workers) as executor:
+                for point, success in zip(remaining, executor.map(lambda point: self.write_single_point(point, writes[point]), remaining)):
+                    results[point] = success
+
+        for point in writes:
+            if results[point]:
+                self.update_out_of_service(point, writes[point])
+        return results
+
+    def get_write_properties(self, point_name, value, priority):
+        # list of (property, value, priority) to write for a point, None values relinquish
+        obj_type = self.object_ids[point_name][0]
+        relinquish = value is None or (type(value) == str and value.lower() == 'null')
+        if obj_type in self.INPUT_TYPES:
+            # inputs are not commandable: relinquishing puts them back in service
+            if relinquish:
+                return [('outOfService', False, None)]
+            properties = []
+            if point_name not in self.out_of_service:
+                properties.append(('outOfService', True, None))
+            properties.append(('presentValue', value, None))
+            return properties
+        return [('presentValue', None if relinquish else value, priority)]
+
+    def update_out_of_service(self, point_name, properties):
+        for prop, value, priority in properties:
+            if prop == 'outOfService':
+                if value:
+                    self.out_of_service.add(point_name)
+                else:
+                    self.out_of_service.discard(point_name)
+
+    def encode_value(self, obj_type, prop, value):
+        datatype = get_datatype(obj_type, prop)
+        if value is None:
+            value = Null()
+        elif issubclass(datatype, Real):
+            value = datatype(float(value))
+        elif issubclass(datatype, Unsigned):
+            value = datatype(int(value))
+        else:
+            value = datatype(value)
+        encoded = Any()
+        encoded.cast_in(value)
+        return encoded
+
+    def get_wpm_request(self, writes):
+        '''
+        :param writes: dictionary of bacnet point name: list of (property, value, priority)
+        :return: WritePropertyMultipleRequest, None if a value cannot be encoded
+        '''
+        specs = []
+        try:
+            for point, properties in writes.items():
+                obj_type, obj_inst = self.object_ids[point]
+                values = [PropertyValue(propertyIdentifier=prop, value=self.encode_value(obj_type, prop, value), priority=priority)
+                          for prop, value, priority in properties]
+                specs.append(WriteAccessSpecification(objectIdentifier=(obj_type, int(obj_inst)), listOfProperties=values))
+        except (TypeError, ValueError):
+            # leave invalid values to the single writes, which report them per point
+            return None
+        return WritePropertyMultipleRequest(listOfWriteAccessSpecs=specs)
+
+    def check_wpm_response(self, iocb, writes):
+        self.metrics.observe_points('write_seconds', iocb.elapsed, writes)
+        if isinstance(iocb.ioError, RejectPDU):
+            print("device %s rejected WritePropertyMultiple, falling back to single writes" % self.device_id)
+            self.wpm_supported = False
+        return iocb.ioError is None and isinstance(iocb.ioResponse, SimpleAckPDU)
+
+    def write_batch(self, writes):
+        '''
+        :param writes: dictionary of bacnet point name: list of (property, value, priority)
+        :return: True if the device acknowledged all writes
+        '''
+        request = self.get_wpm_request(writes)
+        if request is None:
+            return False
+        return self.check_wpm_response(self.request_io(request), writes)
+
+    def get_write_requests(self, point_name, properties):
+        '''
+        :return: list of WritePropertyRequest writing properties in order, None if a value cannot be encoded
+        '''
+        obj_type, obj_inst = self.object_ids[point_name]
+        requests = []
+        for prop, value, priority in properties:
             try:
-                self.device[key]  =point_value_dict[key]
-            except:
-                print("error with setting {}".format(key))
-
-    # def read_data(self, points_to_read):
-    #     '''
-    #     Read values of requested points
-    #     :param points_to_read: list of point names
-    #     :return: dictionary of pointname: value
-    #     '''
-    #     # 1. find corresponding bacnet point names
-    #     # 2. read points
-    #     self.bacnet.readMultiple()
-
-    def set_single_point(self, point_name, value):
-        self.bacnet.write()
\ No newline at end of file
+                requests.append(WritePropertyRequest(objectIdentifier=(obj_type, int(obj_inst)), propertyIdentifier=prop,
+                                                     propertyValue=self.encode_value(obj_type, prop, value), priority=priority))
+            except (TypeError, ValueError) as e:
+                print("invalid value %s for %s of %s: %s" % (value, prop, point_name, e))
+                return None
+        return requests
+
+    def check_write_response(self, iocb, point_name):
+        self.metrics.observe('write_seconds', iocb.elapsed, label=point_name)
+        return iocb.ioError is None and isinstance(iocb.ioResponse, SimpleAckPDU)
+
+    def write_single_point(self, point_name, properties):
+        requests = self.get_write_requests(point_name, properties)
+        if requests is None:
+            return False
+        for request in requests:
+            if not self.check_write_response(self.request_io(request), point_name):
+                return False
+        return True
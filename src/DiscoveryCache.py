@@ -0,0 +1,60 @@
+import json
+import os
+import re
+import pandas as pd
+from src.AtomicFile import write_atomic
+
+
+class DiscoveryCache:
+    '''
+    On-disk cache of the point properties discovered on a device and of the object list the test uses,
+    one json file per device. An entry is only used while the device id, address and the device's
+    databaseRevision (or, if the device does not report it, the size of its object list) still match.
+    '''
+    def __init__(self, folder):
+        '''
+        :param folder: folder of the cache files, created if needed
+        '''
+        self.folder = folder
+
+    def get_filename(self, device_id, device_address):
+        address = re.sub(r"[^0-9A-Za-z.]", "_", str(device_address))
+        return os.path.join(self.folder, "device_%s_%s.json" % (device_id, address))
+
+    def load(self, device_id, device_address, revision):
+        '''
+        :param revision: databaseRevision or object count read from the device, the cache is not used if None
+        :return: dictionary with point_properties (DataFrame) and object_list (list or None), None if there is no valid entry
+        '''
+        filename = self.get_filename(device_id, device_address)
+        if revision is None or not os.path.exists(filename):
+            return None
+        try:
+            with open(filename, "r") as fp:
+                entry = json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+        if entry.get('device_id') != device_id or entry.get('device_address') != str(device_address) or entry.get('revision') != revision:
+            return None
+
+        point_properties = pd.DataFrame.from_dict(entry['point_properties'], orient='index')
+        object_list = entry.get('object_list')
+        if object_list is not None:
+            object_list = [tuple(obj) for obj in object_list]
+        return {'point_properties': point_properties, 'object_list': object_list}
+
+    def save(self, device_id, device_address, revision, point_properties, object_list=None):
+        if revision is None:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        entry = {'device_id': device_id, 'device_address': str(device_address), 'revision': revision,
+                 'object_list': [list(obj) for obj in object_list] if object_list is not None else None,
+                 'point_properties': point_properties.to_dict(orient='index')}
+
+        write_atomic(self.get_filename(device_id, device_address), json.dumps(entry, indent=2, default=str))
+
+    def invalidate(self, device_id, device_address):
+        filename = self.get_filename(device_id, device_address)
+        if os.path.exists(filename):
+            os.remove(filename)
@@ -0,0 +1,116 @@
+import re
+
+# operators and parentheses, numbers (also in exponent form, e.g. 1e-3) unless they start a name;
+# everything else up to the next operator or parenthesis is a variable name
+TOKEN_PATTERN = re.compile(r"\s*(?:([+\-*/()])|((?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?(?![^+\-*/()\s]))|([^+\-*/()\s]+))")
+
+
+class Expression:
+    '''
+    Arithmetic expression of the test script (e.g. "=(SupAirTempSp-2)*1.5"), parsed once into a closure.
+    Variable names are resolved to BACnet point names at compile time, evaluation only takes
+    a dictionary of already read point values.
+    Supports +, -, *, / with the usual precedence, unary minus and parentheses.
+    '''
+    def __init__(self, expression, resolve_name):
+        '''
+        :param expression: expression string, with or without the leading "="
+        :param resolve_name: function returning the BACnet point name of a test variable name, or None if not a point
+        '''
+        if expression.startswith("="):
+            expression = expression[1:]
+        self.expression = expression
+        self.resolve_name = resolve_name
+        self.variables = []
+
+        self.tokens = self.tokenize(expression)
+        self.position = 0
+        self.evaluate_fn = self.parse_sum()
+        if self.position != len(self.tokens):
+            raise Exception("unexpected '%s' in expression %s" % (self.tokens[self.position], expression))
+        del self.tokens
+
+    def __repr__(self):
+        return "Expression(%s)" % self.expression
+
+    def evaluate(self, values):
+        '''
+        :param values: dictionary of bacnet point name: value, must hold all points in self.variables
+        :return: value of the expression
+        '''
+        return self.evaluate_fn(values)
+
+    def tokenize(self, expression):
+        tokens = []
+        position = 0
+        expression = expression.rstrip()
+        while position < len(expression):
+            match = TOKEN_PATTERN.match(expression, position)
+            tokens.append(match.group(1) or match.group(2) or match.group(3))
+            position = match.end()
+        return tokens
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def next_token(self):
+        token = self.peek()
+        if token is None:
+            raise Exception("unexpected end of expression %s" % self.expression)
+        self.position += 1
+        return token
+
+    def parse_sum(self):
+        left = self.parse_product()
+        while self.peek() in ('+', '-'):
+            operator = self.next_token()
+            right = self.parse_product()
+            if operator == '+':
+                left = (lambda l, r: lambda values: l(values) + r(values))(left, right)
+            else:
+                left = (lambda l, r: lambda values: l(values) - r(values))(left, right)
+        return left
+
+    def parse_product(self):
+        left = self.parse_unary()
+        while self.peek() in ('*', '/'):
+            operator = self.next_token()
+            right = self.parse_unary()
+            if operator == '*':
+                left = (lambda l, r: lambda values: l(values) * r(values))(left, right)
+            else:
+                left = (lambda l, r: lambda values: l(values) / r(values))(left, right)
+        return left
+
+    def parse_unary(self):
+        if self.peek() == '-':
+            self.next_token()
+            operand = self.parse_unary()
+            return lambda values: -operand(values)
+        if self.peek() == '+':
+            self.next_token()
+        return self.parse_atom()
+
+    def parse_atom(self):
+        token = self.next_token()
+        if token == '(':
+            inner = self.parse_sum()
+            if self.next_token() != ')':
+                raise Exception("missing ')' in expression %s" % self.expression)
+            return inner
+        if token in ('+', '-', '*', '/', ')'):
+            raise Exception("unexpected '%s' in expression %s" % (token, self.expression))
+
+        point_name = self.resolve_name(token)
+        if point_name is not None:
+            if point_name not in self.variables:
+                self.variables.append(point_name)
+            return lambda values: values[point_name]
+
+        try:
+            constant = float(token)
+        except ValueError:
+            raise Exception("cannot find variable %s" % token)
+        return lambda values: constant
@@ -0,0 +1,171 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Metrics:
+    '''
+    Counts and latencies of the hot paths of a test run: BACnet reads and writes per point, expression evaluation,
+    condition check iterations and ramp tick jitter. Each metric keeps only count / sum / max per label, so
+    observing is a dictionary update under a lock and the metrics can stay on in production runs.
+    '''
+    # metric name: help text
+    METRICS = {
+        'read_seconds': "BACnet read request latency, per point",
+        'write_seconds': "BACnet write request latency, per point",
+        'expression_seconds': "time spent evaluating test script expressions",
+        'condition_iteration_seconds': "time spent in one iteration of the condition check loop",
+        'condition_wait_seconds': "time spent waiting for step conditions",
+        'ramp_jitter_seconds': "delay of ramp and periodic updates after their scheduled time, per point",
+    }
+    PREFIX = "g36_"
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        # metric name: {label: [count, sum, max]}
+        self.values = {name: {} for name in self.METRICS}
+        # metric name: {label: max} since the start of the current step, see start_step
+        self.step_max = {name: {} for name in self.METRICS}
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, label=""):
+        if not self.enabled:
+            return
+        with self.lock:
+            summary = self.values[name].get(label)
+            if summary is None:
+                self.values[name][label] = [1, value, value]
+            else:
+                summary[0] += 1
+                summary[1] += value
+                if value > summary[2]:
+                    summary[2] = value
+            step_max = self.step_max[name]
+            if value > step_max.get(label, float('-inf')):
+                step_max[label] = value
+
+    def observe_points(self, name, value, points):
+        # one request for several points counts for each of them
+        for point in points:
+            self.observe(name, value, label=point)
+
+    def snapshot(self):
+        with self.lock:
+            return self.copy_values()
+
+    def copy_values(self):
+        return {name: {label: list(summary) for label, summary in labels.items()} for name, labels in self.values.items()}
+
+    def start_step(self):
+        '''
+        Start the per step max values over again
+        :return: snapshot to pass to get_step_metrics at the end of the step
+        '''
+        with self.lock:
+            self.step_max = {name: {} for name in self.METRICS}
+            return self.copy_values()
+
+    def get_totals(self, snapshot, name, since=None):
+        # count and sum of a metric over all labels, counting only what was observed after since
+        count = 0
+        total = 0.0
+        for label, (label_count, label_sum, label_max) in snapshot[name].items():
+            previous = since[name].get(label) if since is not None else None
+            if previous is not None:
+                if label_count == previous[0]:
+                    continue
+                label_count -= previous[0]
+                label_sum -= previous[1]
+            count += label_count
+            total += label_sum
+        return count, total
+
+    def get_step_metrics(self, since):
+        '''
+        :param since: snapshot returned by start_step at the start of the step
+        :return: dictionary of the metrics observed since then
+        '''
+        with self.lock:
+            current = self.copy_values()
+            step_max = {name: max(labels.values(), default=None) for name, labels in self.step_max.items()}
+        step_metrics = {}
+        for name in ('read_seconds', 'write_seconds', 'expression_seconds', 'ramp_jitter_seconds'):
+            count, total = self.get_totals(current, name, since)
+            key = name[:-len('_seconds')]
+            step_metrics[key + '_count'] = count
+            step_metrics[key + '_mean'] = total / count if count else None
+            step_metrics[key + '_max'] = step_max[name] if count else None
+
+        iterations, iteration_time = self.get_totals(current, 'condition_iteration_seconds', since)
+        waits, wait_time = self.get_totals(current, 'condition_wait_seconds', since)
+        step_metrics['condition_iterations'] = iterations
+        step_metrics['condition_iterations_per_second'] = iterations / wait_time if wait_time > 0 else None
+        step_metrics['condition_iteration_mean'] = iteration_time / iterations if iterations else None
+        return step_metrics
+
+    def to_dict(self):
+        return {name: {label: {'count': count, 'sum': total, 'max': maximum} for label, (count, total, maximum) in labels.items()}
+                for name, labels in self.snapshot().items()}
+
+    def to_prometheus(self):
+        lines = []
+        for name, labels in self.snapshot().items():
+            metric = self.PREFIX + name
+            lines.append("# HELP %s %s" % (metric, self.METRICS[name]))
+            lines.append("# TYPE %s summary" % metric)
+            for label, (count, total, maximum) in sorted(labels.items()):
+                tag = '{point="%s"}' % label if label else ""
+                lines.append("%s_count%s %d" % (metric, tag, count))
+                lines.append("%s_sum%s %.6f" % (metric, tag, total))
+            lines.append("# TYPE %s_max gauge" % metric)
+            for label, (count, total, maximum) in sorted(labels.items()):
+                tag = '{point="%s"}' % label if label else ""
+                lines.append("%s_max%s %.6f" % (metric, tag, maximum))
+        return "\n".join(lines) + "\n"
+
+
+class Timer:
+    '''
+    Context manager observing the time spent in its block, on the performance counter
+    '''
+    def __init__(self, metrics, name, label=""):
+        self.metrics = metrics
+        self.name = name
+        self.label = label
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = time.perf_counter() - self.start_time
+        self.metrics.observe(self.name, self.elapsed, label=self.label)
+
+
+class MetricsServer:
+    '''
+    Local http endpoint serving the metrics in the Prometheus text format at /metrics
+    '''
+    def __init__(self, metrics, port, host="127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name="MetricsServer %d" % port, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
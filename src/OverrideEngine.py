@@ -0,0 +1,159 @@
+from src.Clock import PeriodicDeadline
+from src.Metrics import Metrics
+from src.RateLimiter import RateLimiter
+
+
+class OverrideEngine:
+    '''
+    Commands the inputs of a device during a test. It remembers the last value it wrote to every point, so
+    unchanged values are skipped without reading the device back. Ramps are computed in closed form from the
+    step start, all ramp and periodic updates due at the same time are written in one batch, and the number of
+    points written per second can be capped.
+    '''
+    def __init__(self, controller, clock, evaluate_expression, max_write_rate=None, digits=2, metrics=None):
+        '''
+        :param controller: Device or SimulatedDevice
+        :param clock: Clock of the test
+        :param evaluate_expression: function evaluating a compiled expression, for periodic updates
+        :param max_write_rate: maximum number of points written per second, no limit if None
+        :param digits: values equal when rounded to this many decimals are not written again
+        :param metrics: Metrics recording the update jitter, not recorded if None
+        '''
+        self.controller = controller
+        self.clock = clock
+        self.evaluate_expression = evaluate_expression
+        self.rate_limiter = RateLimiter(rate=max_write_rate, clock=clock) if max_write_rate else None
+        self.digits = digits
+        self.metrics = metrics or Metrics(enabled=False)
+
+        # bacnet point name: last value written successfully
+        self.commanded = {}
+        # bacnet point name: dictionary of ramp / periodic parameters of the current step
+        self.ramps = {}
+        self.periodics = {}
+        self.deadlines = {}
+
+        self.issued = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def clear(self):
+        # forget the ramps and periodic updates of the previous step
+        self.ramps = {}
+        self.periodics = {}
+        self.deadlines = {}
+
+    def add_ramp(self, point, start, end, rate, period):
+        '''
+        :param rate: ramp rate in value per second
+        :param period: seconds between two updates
+        '''
+        self.ramps[point] = {'ramp_start': start, 'ramp_end': end, 'ramp_rate': rate, 'ramp_period': period}
+
+    def add_periodic(self, point, expression, period):
+        self.periodics[point] = {'periodic_expression': expression, 'period': period}
+
+    def start(self, st):
+        '''
+        Start the updates of the step; the first update is due at st
+        :param st: step start time on the monotonic clock
+        '''
+        self.deadlines = {}
+        for point, params in self.ramps.items():
+            # if start == end, no ramping
+            if params['ramp_start'] != params['ramp_end']:
+                self.deadlines[point] = PeriodicDeadline(start=st, period=params['ramp_period'])
+        for point, params in self.periodics.items():
+            self.deadlines[point] = PeriodicDeadline(start=st, period=params['period'])
+
+    @property
+    def next_time(self):
+        # monotonic time of the next update, None if the step has none
+        if not self.deadlines:
+            return None
+        return min(deadline.next_time for deadline in self.deadlines.values())
+
+    def get_ramp_value(self, params, tick):
+        ramp_start = params['ramp_start']
+        ramp_end = params['ramp_end']
+        ramp_rate = params['ramp_rate']
+        ramp_period = params['ramp_period']
+
+        value_to_set = ramp_start
+        if ramp_start < ramp_end:
+            value_to_set = min(ramp_end, ramp_start + ramp_rate * tick * ramp_period)
+        elif ramp_start > ramp_end:
+            value_to_set = max(ramp_end, ramp_start - ramp_rate * tick * ramp_period)
+        return value_to_set
+
+    def update(self, now):
+        '''
+        Write the ramp and periodic values due at now
+        :return: dictionary of bacnet point name: value written
+        '''
+        values = {}
+        for point, deadline in self.deadlines.items():
+            tick = deadline.due(now)
+            if tick is None:
+                continue
+            self.metrics.observe('ramp_jitter_seconds', now - (deadline.start + tick * deadline.period), label=point)
+            if point in self.ramps:
+                values[point] = self.get_ramp_value(params=self.ramps[point], tick=tick)
+            else:
+                values[point] = self.evaluate_expression(expression=self.periodics[point]['periodic_expression'])
+        if not values:
+            return {}
+
+        results = self.write(values)
+        return {point: values[point] for point in results if results[point]}
+
+    def is_commanded(self, point, value):
+        if point not in self.commanded:
+            return False
+        commanded = self.commanded[point]
+        try:
+            return round(float(value), self.digits) == round(float(commanded), self.digits)
+        except (TypeError, ValueError):
+            return value == commanded
+
+    def write(self, values, force=False):
+        '''
+        Write values in one batch, skipping the points already commanded to the same value
+        :param values: dictionary of bacnet point name: value
+        :param force: write all values, e.g. the inputs at the start of a step
+        :return: dictionary of bacnet point name: True if written, only for the points actually written
+        '''
+        to_write = {}
+        for point, value in values.items():
+            if not force and self.is_commanded(point, value):
+                self.skipped += 1
+            else:
+                to_write[point] = value
+        if not to_write:
+            return {}
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(tokens=len(to_write))
+        results = self.controller.write_values(point_value_dict=to_write)
+        for point, success in results.items():
+            if success:
+                self.issued += 1
+                self.commanded[point] = to_write[point]
+            else:
+                self.failed += 1
+                # the value on the device is unknown now
+                self.commanded.pop(point, None)
+        return results
+
+    def forget(self, points=None):
+        '''
+        Forget the commanded values, e.g. after the inputs were relinquished or changed outside the test
+        '''
+        if points is None:
+            self.commanded = {}
+        else:
+            for point in points:
+                self.commanded.pop(point, None)
+
+    def get_counters(self):
+        return {'issued': self.issued, 'skipped': self.skipped, 'failed': self.failed}
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+from src.AtomicFile import write_atomic
+from src.Expression import Expression
+from src.TestPlan import TestPlan, ConstantInput, ExpressionInput, RampInput, PeriodicInput, Condition, ValueCheck, \
+    ExpressionCheck, LastCheck, Dependencies, Step
+
+# typed tuples of a TestPlan, saved as {"type": name, "fields": [...]}
+PLAN_TYPES = {cls.__name__: cls for cls in (ConstantInput, ExpressionInput, RampInput, PeriodicInput, Condition, ValueCheck,
+                                            ExpressionCheck, LastCheck, Dependencies, Step)}
+
+
+class PlanCache:
+    '''
+    Compiled TestPlan of a test script saved next to the spreadsheet (<script>.plan), so later runs skip reading
+    and parsing the workbook. An entry is only used while the hashes of the script file and of the point map
+    and the section headers still match. The plan is saved as json, expressions as their source, compiled again on load.
+    '''
+    # increase when the layout of TestPlan or its steps changes
+    VERSION = 4
+
+    def __init__(self, folder):
+        '''
+        :param folder: folder of the test scripts
+        '''
+        self.folder = folder
+
+    def get_filename(self, script_file):
+        return os.path.join(self.folder, script_file + ".plan")
+
+    def get_key(self, script_hash, test_to_bacnet, headers):
+        '''
+        :param script_hash: sha256 of the test script file
+        :param test_to_bacnet: point map of the device, test variable name: bacnet point name
+        :param headers: input, condition and output section headers of the script
+        '''
+        point_map = hashlib.sha256(repr(sorted(test_to_bacnet.items())).encode()).hexdigest()
+        return {'version': self.VERSION, 'script_hash': script_hash, 'point_map': point_map, 'headers': list(headers)}
+
+    def load(self, script_file, key, compile_expression):
+        '''
+        :return: the cached TestPlan, None if there is no valid entry
+        '''
+        filename = self.get_filename(script_file)
+        if not os.path.exists(filename):
+            return None
+        try:
+            with open(filename, "r") as fp:
+                # the key is on the first line, so a stale entry is rejected without parsing the plan
+                if json.loads(fp.readline()) != key:
+                    return None
+                plan = json.loads(fp.read(), object_hook=lambda value: self.decode(value, compile_expression))
+            return TestPlan.from_steps(steps=plan['steps'], input_points=tuple(plan['input_points']),
+                                       output_points=tuple(plan['output_points']), compile_expression=compile_expression)
+        except Exception as e:
+            print("ignoring test plan cache %s: %s" % (filename, e))
+            return None
+
+    def save(self, script_file, key, plan):
+        data = {'input_points': list(plan.input_points), 'output_points': list(plan.output_points), 'steps': self.encode(plan.steps)}
+        write_atomic(self.get_filename(script_file), json.dumps(key) + "\n" + json.dumps(data))
+
+    def encode(self, value):
+        if isinstance(value, Expression):
+            return {'expression': value.expression}
+        if isinstance(value, tuple):
+            fields = [self.encode(item) for item in value]
+            if type(value).__name__ in PLAN_TYPES:
+                return {'type': type(value).__name__, 'fields': fields}
+            return fields
+        if value is None or isinstance(value, (str, int, float)):
+            return value
+        # numpy scalars of the spreadsheet cells
+        if hasattr(value, 'item'):
+            return value.item()
+        raise Exception("cannot save %r in the test plan cache" % (value,))
+
+    def decode(self, value, compile_expression):
+        # object_hook of json.loads, called for every json object from the innermost out
+        if 'expression' in value:
+            return compile_expression(value['expression'])
+        if 'type' in value:
+            if value['type'] not in PLAN_TYPES:
+                raise Exception("unknown type %s" % value['type'])
+            return PLAN_TYPES[value['type']](*[tuple(item) if isinstance(item, list) else item for item in value['fields']])
+        return value
+
+    def invalidate(self, script_file):
+        filename = self.get_filename(script_file)
+        if os.path.exists(filename):
+            os.remove(filename)
@@ -0,0 +1,104 @@
+import operator
+
+# operators of the step conditions, "last" checks and settle predicates
+OPERATORS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le, '==': operator.eq}
+
+
+class UnmappedPointError(Exception):
+    pass
+
+
+def to_number(value):
+    # binary values compare as 1 / 0
+    if type(value) == str:
+        return 0 if value == 'inactive' else 1
+    return value
+
+
+def compare(op, actual_value, expected_value):
+    '''
+    :return: True if "actual_value op expected_value" holds, False for an unknown operator
+    '''
+    if op not in OPERATORS:
+        return False
+    return OPERATORS[op](actual_value, expected_value)
+
+
+class Point:
+    __slots__ = ('name', 'name_in_test', 'type', 'instance', 'units', 'device_address')
+
+    def __init__(self, name, name_in_test, type, instance, units, device_address=None):
+        self.name = name
+        self.name_in_test = name_in_test
+        self.type = type
+        self.instance = instance
+        self.units = units
+        self.device_address = device_address
+
+    def __repr__(self):
+        return "Point(%s [%s], %s %s, %s)" % (self.name, self.name_in_test, self.type, self.instance, self.units)
+
+    @property
+    def is_percent(self):
+        return self.units == 'percent'
+
+    def normalize(self, value):
+        '''
+        Value of the point as compared with the test script: binary values as 1 / 0, percent values as fractions
+        '''
+        value = to_number(value)
+        if self.is_percent:
+            return value/100
+        return value
+
+
+class PointRegistry:
+    '''
+    Index of the mapped points, built once from the merged point properties.
+    Translates test variable names to BACnet point names and back with dictionary lookups.
+    '''
+    def __init__(self, point_properties, device_address=None):
+        '''
+        :param point_properties: point properties DataFrame indexed by bacnet name, with the name_in_test column of the point map
+        :param device_address: address of the device the points belong to
+        '''
+        self.points = {}
+        self.test_to_bacnet = {}
+        self.bacnet_to_test = {}
+
+        for name, name_in_test, obj_type, instance, units in zip(point_properties.index, point_properties['name_in_test'],
+                                                                 point_properties['type'], point_properties['address'],
+                                                                 point_properties['units_state']):
+            self.points[name] = Point(name=name, name_in_test=name_in_test, type=obj_type, instance=instance, units=units,
+                                      device_address=device_address)
+            self.test_to_bacnet[name_in_test] = name
+            self.bacnet_to_test[name] = name_in_test
+
+        self.names = sorted(self.points)
+
+    def __len__(self):
+        return len(self.points)
+
+    def __contains__(self, name):
+        return name in self.points
+
+    def get(self, name):
+        try:
+            return self.points[name]
+        except KeyError:
+            raise UnmappedPointError("BACnet point %s is not in the point map" % name)
+
+    def to_bacnet(self, name_in_test):
+        try:
+            return self.test_to_bacnet[name_in_test]
+        except KeyError:
+            raise UnmappedPointError("test variable %s is not in the point map or not found on the device" % name_in_test)
+
+    def to_test(self, name):
+        try:
+            return self.bacnet_to_test[name]
+        except KeyError:
+            raise UnmappedPointError("BACnet point %s is not in the point map" % name)
+
+    def find_bacnet_name(self, name_in_test):
+        return self.test_to_bacnet.get(name_in_test)
@@ -0,0 +1,49 @@
+import threading
+import time
+
+
+class RateLimiter:
+    '''
+    Token bucket limiting the number of BACnet requests per second sent on one trunk.
+    Shared by all Device objects on that trunk, safe to use from several threads.
+    '''
+    def __init__(self, rate, burst=1, clock=None):
+        '''
+        :param rate: requests per second
+        :param burst: number of requests that can be sent back to back after an idle period
+        :param clock: Clock to measure and wait on, real time if None
+        '''
+        self.rate = float(rate)
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.last_update = self.monotonic()
+        self.lock = threading.Lock()
+
+    def monotonic(self):
+        if self.clock is not None:
+            return self.clock.monotonic()
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        if self.clock is not None:
+            self.clock.sleep(seconds)
+        else:
+            time.sleep(seconds)
+
+    def acquire(self, tokens=1):
+        '''
+        :param tokens: number of requests to send; a batch larger than burst waits for a full bucket
+                       and the excess delays the following requests
+        '''
+        needed = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                now = self.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.rate)
+                self.last_update = now
+                if self.tokens >= needed:
+                    self.tokens -= tokens
+                    return
+                wait_time = (needed - self.tokens) / self.rate
+            self.sleep(wait_time)
@@ -0,0 +1,114 @@
+import yaml
+import json
+import BAC0
+from src.RateLimiter import RateLimiter
+from src.Test import Test
+from concurrent.futures import ThreadPoolExecutor
+import time
+import argparse
+
+
+class Runner:
+    '''
+    Runs the test script against several controllers at the same time, one thread per controller,
+    over a single shared BAC0 network. Requests are rate limited per trunk.
+    '''
+    def __init__(self, config_file="config.yaml"):
+        self.FILE_FOLDER = "./files/"
+        self.SRC_FOLDER = "./src/"
+        self.config_file = config_file
+
+        with open(self.SRC_FOLDER+config_file, "r") as fp:
+            self.config = yaml.safe_load(fp)
+
+        self.device_configs = self.config["devices"]
+        self.trunk_request_rate = self.config.get("trunk_request_rate")
+
+        network_address = self.config.get("network_address") or (self.config.get("device") or {}).get("network_address")
+        self.bacnet = BAC0.connect(ip=network_address)
+
+        self.rate_limiters = {}
+        if self.trunk_request_rate:
+            for device_config in self.device_configs:
+                trunk = self.get_trunk(device_config)
+                if trunk not in self.rate_limiters:
+                    self.rate_limiters[trunk] = RateLimiter(rate=self.trunk_request_rate)
+
+    def get_trunk(self, device_config):
+        # devices behind a router ("network:mac") share the trunk of their network number
+        if "trunk" in device_config:
+            return str(device_config["trunk"])
+        address = str(device_config["device_address"])
+        if ":" in address:
+            return address.split(":")[0]
+        return address
+
+    def get_device_name(self, device_config):
+        return str(device_config.get("name", device_config["device_id"]))
+
+    def get_metrics_config(self, index, device_config):
+        # devices without their own metrics_port serve their metrics at the metrics_port of the test section + their index
+        base_port = (self.config.get("test") or {}).get("metrics_port")
+        if not base_port or device_config.get("metrics_port"):
+            return device_config
+        return dict(device_config, metrics_port=int(base_port) + index)
+
+    def run_device(self, device_config, to_csv=False, name=None, refresh_cache=False, resume=False, continue_on_failure=None):
+        device_name = self.get_device_name(device_config)
+        report = {'device': device_name, 'device_id': device_config["device_id"],
+                  'device_address': str(device_config["device_address"]), 'passed': False, 'error': None}
+
+        start_time = time.time()
+        try:
+            test = Test(config_file=self.config_file, device_config=device_config, network=self.bacnet,
+                        rate_limiter=self.rate_limiters.get(self.get_trunk(device_config)), refresh_cache=refresh_cache)
+            report['discovery_time'] = round(test.controller.discovery_time, 1)
+            report['passed'] = bool(test.start_test(to_csv=to_csv, name="%s_%s" % (name, device_name), resume=resume,
+                                                           continue_on_failure=continue_on_failure))
+            report['last_step'] = test.current_step
+            report['writes'] = test.overrides.get_counters()
+            report['failed_checks'] = len(test.failures)
+        except Exception as e:
+            print("device %s: test aborted with error: %s" % (device_name, e))
+            report['error'] = str(e)
+        report['duration'] = round((time.time() - start_time) / 60, 2)
+        return report
+
+    def run(self, to_csv=False, name=None, refresh_cache=False, resume=False, continue_on_failure=None):
+        '''
+        Run the test on all devices; a failure or exception on one device does not stop the others
+        :return: list of per device reports
+        '''
+        with ThreadPoolExecutor(max_workers=len(self.device_configs)) as executor:
+            futures = [executor.submit(self.run_device, self.get_metrics_config(index, device_config), to_csv, name, refresh_cache,
+                                       resume, continue_on_failure) for index, device_config in enumerate(self.device_configs)]
+            reports = [future.result() for future in futures]
+
+        self.print_report(reports)
+        with open(self.FILE_FOLDER + name + "_report.json", "w") as fp:
+            json.dump(reports, fp, indent=2)
+        return reports
+
+    def print_report(self, reports):
+        print("device\tpassed\tduration (minutes)\terror")
+        for report in reports:
+            print("%s\t%s\t%s\t%s" % (report['device'], report['passed'], report['duration'], report['error'] or ""))
+        print("%d of %d devices passed" % (sum(report['passed'] for report in reports), len(reports)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="config file in src/ with a devices list", default="config.yaml")
+    parser.add_argument("--csv", help="save outputs to csv", action='store_true')
+    parser.add_argument("--name", help="test name, the current time by default")
+    parser.add_argument("--resume", help="continue the tests of run --name after their last completed step", action='store_true')
+    parser.add_argument("--refresh-cache", help="discover the devices again instead of using the cached points", action='store_true')
+    parser.add_argument("--continue-on-failure", help="run all steps and save the results of every check", action='store_true')
+
+    args = parser.parse_args()
+    if args.resume and not args.name:
+        parser.error("--resume needs the --name of the interrupted run")
+
+    runner = Runner(config_file=args.config)
+    runner.run(to_csv=args.csv, name=args.name or time.strftime("%Y%m%dT%H%M%S"), refresh_cache=args.refresh_cache, resume=args.resume,
+               continue_on_failure=args.continue_on_failure or None)
@@ -0,0 +1,119 @@
+import re
+from collections import namedtuple
+from src.PointRegistry import compare
+
+# variable operator value, e.g. "CoolLoopOut <= 0" or "OutDamPos <= 15%"
+PREDICATE_PATTERN = re.compile(r"\A\s*(\S+?)\s*(>=|<=|==|>|<)\s*(\S+)\s*\Z")
+
+Predicate = namedtuple('Predicate', ['variable', 'point', 'operator', 'value'])
+
+
+class SettleEngine:
+    '''
+    Waits until the controller has settled, i.e. until all predicates over its points hold, e.g. all loop outputs
+    at 0 or the dampers at their minimum. Each check reads only the points of the predicates, in one batched
+    request. The time between two checks grows by backoff while the values do not change, up to max_poll_interval,
+    and goes back to poll_interval as soon as they move.
+    '''
+    DEFAULT_PREDICATES = ["CoolLoopOut == 0"]
+
+    def __init__(self, controller, registry, clock, predicates=None, timeout=600, poll_interval=1, max_poll_interval=30,
+                 backoff=2, tolerance=0):
+        '''
+        :param controller: Device or SimulatedDevice
+        :param registry: PointRegistry of the test
+        :param clock: Clock of the test
+        :param predicates: list of "variable operator value" strings with test variable names, all must hold;
+                           DEFAULT_PREDICATES if None
+        :param timeout: seconds to wait before giving up
+        :param poll_interval: seconds between the first checks
+        :param max_poll_interval: longest time between two checks
+        :param backoff: factor the time between two checks grows by while the values do not change
+        :param tolerance: largest difference still counted as equal by ==
+        '''
+        self.controller = controller
+        self.registry = registry
+        self.clock = clock
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max(poll_interval, max_poll_interval)
+        self.backoff = backoff
+        self.tolerance = tolerance
+
+        self.predicates = []
+        for text in (predicates if predicates is not None else self.DEFAULT_PREDICATES):
+            predicate = self.parse_predicate(text)
+            if predicate.point is None:
+                if predicates is not None:
+                    raise Exception("settle variable %s is not in the point map" % predicate.variable)
+                print("%s is not in the point map, not waiting for it to settle" % predicate.variable)
+                continue
+            self.predicates.append(predicate)
+        self.points = sorted(set(predicate.point for predicate in self.predicates))
+
+    def parse_predicate(self, text):
+        match = PREDICATE_PATTERN.match(str(text))
+        if match is None:
+            raise Exception("invalid settle predicate %s, expected <variable> <operator> <value>" % text)
+        variable, op, value = match.groups()
+        try:
+            if value.endswith("%"):
+                value = float(value[:-1])/100
+            else:
+                value = float(value)
+        except ValueError:
+            raise Exception("invalid value in settle predicate %s" % text)
+        return Predicate(variable=variable, point=self.registry.find_bacnet_name(variable), operator=op, value=value)
+
+    def holds(self, predicate, values):
+        # compared like the step conditions
+        actual = self.registry.get(predicate.point).normalize(values[predicate.point])
+        if predicate.operator == "==":
+            return abs(actual - predicate.value) <= self.tolerance
+        return compare(predicate.operator, actual, predicate.value)
+
+    def check(self, values):
+        '''
+        :param values: dictionary of bacnet point name: value holding self.points
+        :return: list of the predicates that do not hold
+        '''
+        return [predicate for predicate in self.predicates if not self.holds(predicate, values)]
+
+    def wait(self, timeout=None):
+        '''
+        :param timeout: seconds to wait, self.timeout if None
+        :return: True if all predicates hold, False if they still did not after timeout seconds
+        '''
+        if not self.predicates:
+            return True
+        if timeout is None:
+            timeout = self.timeout
+
+        start_time = self.clock.monotonic()
+        deadline = start_time + timeout
+        interval = self.poll_interval
+        previous = None
+        while True:
+            values = self.controller.read_data(points_to_read=self.points)
+            failing = self.check(values)
+            now = self.clock.monotonic()
+            if not failing:
+                print("controller settled after %.1f seconds" % (now - start_time))
+                return True
+            if now >= deadline:
+                print("controller did not settle within %.1f seconds: %s" % (timeout, self.describe(failing, values)))
+                return False
+
+            if previous is not None:
+                if any(values[point] != previous[point] for point in self.points):
+                    interval = self.poll_interval
+                else:
+                    interval = min(self.max_poll_interval, interval * self.backoff)
+            previous = values
+
+            print("waiting for the controller to settle: %s; next check in %.1f seconds" % (self.describe(failing, values), interval))
+            self.clock.sleep(min(interval, deadline - now))
+
+    def describe(self, predicates, values):
+        return ", ".join("%s = %s (%s %s)" % (predicate.variable, values[predicate.point], predicate.operator, predicate.value)
+                         for predicate in predicates)
@@ -0,0 +1,232 @@
+import json
+import importlib
+import threading
+import time
+import pandas as pd
+from src.Clock import MonotonicClock
+from src.Expression import Expression
+from src.Metrics import Metrics
+
+
+class Model:
+    '''
+    Base class of the sequence models driving the outputs of a SimulatedDevice.
+    step() gets all point values (by bacnet name) and the seconds elapsed since the previous step,
+    and returns a dictionary of point values to update.
+    '''
+    def step(self, values, dt):
+        return {}
+
+
+class LoopModel(Model):
+    '''
+    PI control loop with a 0-100 % output, e.g. a cooling loop driving CoolLoopOut from the supply air
+    temperature and its setpoint. reverse=True for loops whose output rises when the measurement is below setpoint.
+    '''
+    def __init__(self, output, measurement, setpoint, kp=10.0, ti=120.0, reverse=False):
+        self.output = output
+        self.measurement = measurement
+        self.setpoint = setpoint
+        self.kp = kp
+        self.ti = ti
+        self.reverse = reverse
+        self.integral = 0.0
+
+    def step(self, values, dt):
+        error = float(values[self.measurement]) - float(values[self.setpoint])
+        if self.reverse:
+            error = -error
+
+        integral = self.integral + error * dt / self.ti
+        value = self.kp * (error + integral)
+        # anti-windup: only integrate while the output is not saturated
+        if 0 <= value <= 100:
+            self.integral = integral
+        return {self.output: min(100.0, max(0.0, value))}
+
+
+class ExpressionModel(Model):
+    '''
+    Output following an expression of other points (bacnet names), optionally through a first order lag.
+    '''
+    def __init__(self, output, expression, time_constant=0):
+        self.output = output
+        self.expression = Expression(expression=expression, resolve_name=self.resolve_name)
+        self.time_constant = time_constant
+
+    def resolve_name(self, name):
+        try:
+            float(name)
+            return None
+        except ValueError:
+            return name
+
+    def step(self, values, dt):
+        target = self.expression.evaluate(values)
+        if self.time_constant > 0:
+            current = float(values[self.output])
+            target = current + (target - current) * min(1.0, dt / self.time_constant)
+        return {self.output: target}
+
+
+def load_model(spec):
+    '''
+    Create a model from its config entry
+    :param spec: dictionary with "model", either a class name of this module or "package.module:ClassName",
+                 and the keyword arguments of the model
+    '''
+    spec = dict(spec)
+    model_name = spec.pop("model")
+    if ":" in model_name:
+        module_name, class_name = model_name.split(":")
+        model_class = getattr(importlib.import_module(module_name), class_name)
+    else:
+        model_class = globals()[model_name]
+    return model_class(**spec)
+
+
+def write_points_file(point_properties, filename, values=None):
+    '''
+    Save the points of a real device as a points file of SimulatedDevice
+    :param point_properties: point properties DataFrame of Device
+    :param filename: json file to write
+    :param values: optional dictionary of bacnet name: initial value
+    '''
+    points = {}
+    for name, obj_type, instance, units in zip(point_properties.index, point_properties['type'],
+                                               point_properties['address'], point_properties['units_state']):
+        points[name] = {'type': obj_type, 'address': int(instance), 'units_state': units}
+        if values is not None and name in values:
+            points[name]['value'] = values[name]
+    with open(filename, "w") as fp:
+        json.dump(points, fp, indent=2)
+
+
+class SimulatedDevice:
+    '''
+    In-process stand-in for Device. It serves the points of a points file and computes its outputs with
+    pluggable models of the sequences under test. Models only advance with the clock, so with a VirtualClock
+    a whole script runs in seconds and the results do not depend on the speed of the machine.
+    '''
+    FILE_FOLDER = "./files/"
+    # longest model integration step, in seconds
+    MODEL_STEP = 1.0
+
+    def __init__(self, device_config, clock=None, models=None, point_map=None, metrics=None):
+        '''
+        :param device_config: device section of the config with simulated: true, points: <json file in files/>
+                              and optionally a list of models
+        :param clock: Clock shared with the Test, VirtualClock for faster than real time runs
+        :param models: list of Model objects, replaces the models of the config
+        :param point_map: point map file used when the config has no points file; all points are then analog values
+        :param metrics: Metrics recording the read and write latencies, not recorded if None
+        '''
+        self.device_config = device_config
+        self.clock = clock or MonotonicClock()
+        self.device_address = device_config.get("device_address", "simulated")
+        self.device_id = device_config.get("device_id", 0)
+        self.discovery_time = 0.0
+        self.metrics = metrics or Metrics(enabled=False)
+
+        # injected latency to mimic a controller: seconds per request and per point of a request
+        self.latency = device_config.get("latency", 0)
+        self.point_latency = device_config.get("point_latency", 0)
+        # points per read or write request, one request per point if not set
+        self.batch_size = device_config.get("batch_size")
+        self.requests = 0
+        self.init_device(config=device_config, point_map=point_map)
+
+        if models is None:
+            models = [load_model(spec) for spec in device_config.get("models") or []]
+        self.models = models
+
+    def init_device(self, config, point_map=None):
+        if config.get("points"):
+            with open(self.FILE_FOLDER + config["points"], "r") as fp:
+                points = json.load(fp)
+        else:
+            with open(self.FILE_FOLDER + point_map, "r") as fp:
+                mapping_dict = json.load(fp)
+            points = {}
+            for i, name in enumerate(mapping_dict.values()):
+                points[name] = {'type': 'analogValue', 'address': i, 'units_state': 'noUnits'}
+
+        self.point_properties = pd.DataFrame.from_dict(points, orient='index')
+        self.point_properties['name'] = self.point_properties.index
+        self.values = {name: points[name].get('value', 0.0) for name in points}
+        self.object_list = []
+
+        self.lock = threading.Lock()
+        self.last_update = self.clock.monotonic()
+
+    def get_point_properties(self):
+        return self.point_properties
+
+    def reset_device(self, object_list):
+        # like Device, the objects of every point map used so far stay loaded and all points stay discoverable
+        self.object_list = sorted(set(self.object_list) | set((obj_type, int(instance)) for obj_type, instance in object_list))
+
+    def advance(self):
+        # run the models up to the current clock time
+        now = self.clock.monotonic()
+        remaining = now - self.last_update
+        self.last_update = now
+        while remaining > 0:
+            dt = min(self.MODEL_STEP, remaining)
+            remaining -= dt
+            for model in self.models:
+                self.values.update(model.step(self.values, dt))
+
+    def wait_for_requests(self, count):
+        # block on the clock as long as count points would take, without holding the lock
+        batch_size = self.batch_size or 1
+        for i in range(0, count, batch_size):
+            self.requests += 1
+            if self.latency or self.point_latency:
+                self.clock.sleep(self.latency + self.point_latency * min(batch_size, count - i))
+
+    def read_data(self, points_to_read):
+        start_time = time.perf_counter()
+        self.wait_for_requests(len(points_to_read))
+        with self.lock:
+            self.advance()
+            values = {point: self.values[point] for point in points_to_read}
+        self.metrics.observe_points('read_seconds', time.perf_counter() - start_time, points_to_read)
+        return values
+
+    def set_single_point(self, point_name, value, priority=None):
+        return self.write_values(point_value_dict={point_name: value}, priority=priority)[point_name]
+
+    def write_values(self, point_value_dict, priority=None):
+        '''
+        Same interface as Device.write_values; the priority is ignored and relinquished points keep their value
+        '''
+        start_time = time.perf_counter()
+        self.wait_for_requests(len(point_value_dict))
+        results = {}
+        with self.lock:
+            self.advance()
+            for point_name, value in point_value_dict.items():
+                if point_name not in self.values:
+                    results[point_name] = False
+                    continue
+                results[point_name] = True
+                if value is None or (type(value) == str and value.lower() == 'null'):
+                    continue
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    pass
+                self.values[point_name] = value
+        self.metrics.observe_points('write_seconds', time.perf_counter() - start_time, point_value_dict)
+        return results
+
+    def set_values(self, point_value_dict, priority=None):
+        return self.write_values(point_value_dict=point_value_dict, priority=priority)
+
+    def subscribe_cov(self, point_name, callback, lifetime=None):
+        # notifications would need the models to run ahead of the clock, let the Test poll
+        return False
+
+    def unsubscribe_cov(self, point_name):
+        pass
@@ -0,0 +1,105 @@
+import yaml
+import json
+import os
+from src.Test import Test
+import time
+import argparse
+
+
+class Suite:
+    '''
+    Runs a list of test scripts back to back on the device of the device section. The device connection, its
+    discovered points and the point registry of each point map are set up by the first script and reused by the
+    others; before every following script the controller is reset to the first step of that script.
+    '''
+    def __init__(self, config_file="config.yaml", refresh_cache=False):
+        self.FILE_FOLDER = "./files/"
+        self.SRC_FOLDER = "./src/"
+        self.config_file = config_file
+        self.refresh_cache = refresh_cache
+
+        with open(self.SRC_FOLDER+config_file, "r") as fp:
+            self.config = yaml.safe_load(fp)
+
+        # entries of the suite list override the test section, e.g. test_script and point_map
+        self.script_configs = self.config.get("suite") or []
+        if not self.script_configs:
+            raise Exception("no suite list of test scripts in src/%s" % config_file)
+        self.reset_between_scripts = self.config.get("reset_between_scripts", True)
+
+        self.controller = None
+        self.clock = None
+        # point map file: PointRegistry
+        self.registries = {}
+
+    def get_script_name(self, script_config):
+        return os.path.splitext(os.path.basename(script_config["test_script"]))[0]
+
+    def make_test(self, script_config):
+        point_map = script_config.get("point_map", self.config["test"].get("point_map"))
+        test = Test(config_file=self.config_file, clock=self.clock, refresh_cache=self.refresh_cache, test_config=script_config,
+                    controller=self.controller, registry=self.registries.get(point_map))
+        self.controller = test.controller
+        self.clock = test.clock
+        self.registries[point_map] = test.registry
+        return test
+
+    def run_script(self, index, script_config, to_csv=False, name=None, continue_on_failure=None):
+        script_name = self.get_script_name(script_config)
+        report = {'script': script_config["test_script"], 'passed': False, 'error': None}
+
+        start_time = time.time()
+        try:
+            test = self.make_test(script_config)
+            report['setup_time'] = round(time.time() - start_time, 1)
+            if index > 0 and self.reset_between_scripts:
+                test.reset()
+            report['passed'] = bool(test.start_test(to_csv=to_csv, name="%s_%02d_%s" % (name, index + 1, script_name),
+                                                    continue_on_failure=continue_on_failure))
+            report['last_step'] = test.current_step
+            report['steps'] = len(test.plan)
+            report['failed_checks'] = len(test.failures)
+            report['writes'] = test.overrides.get_counters()
+        except Exception as e:
+            print("script %s: aborted with error: %s" % (script_name, e))
+            report['error'] = str(e)
+        report['duration'] = round((time.time() - start_time) / 60, 2)
+        return report
+
+    def run(self, to_csv=False, name=None, continue_on_failure=None):
+        '''
+        Run all scripts in order; a failure or exception in one script does not stop the others
+        :return: list of per script reports
+        '''
+        reports = []
+        for index, script_config in enumerate(self.script_configs):
+            print("running test script %d of %d: %s" % (index + 1, len(self.script_configs), script_config["test_script"]))
+            reports.append(self.run_script(index=index, script_config=script_config, to_csv=to_csv, name=name,
+                                           continue_on_failure=continue_on_failure))
+            print()
+
+        self.print_report(reports)
+        with open(self.FILE_FOLDER + name + "_suite.json", "w") as fp:
+            json.dump({'passed': all(report['passed'] for report in reports), 'scripts': reports}, fp, indent=2)
+        return reports
+
+    def print_report(self, reports):
+        print("script\tpassed\tsetup (seconds)\tduration (minutes)\terror")
+        for report in reports:
+            print("%s\t%s\t%s\t%s\t%s" % (report['script'], report['passed'], report.get('setup_time', ""), report['duration'],
+                                          report['error'] or ""))
+        print("%d of %d scripts passed" % (sum(report['passed'] for report in reports), len(reports)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="config file in src/ with a suite list", default="config.yaml")
+    parser.add_argument("--csv", help="save outputs to csv", action='store_true')
+    parser.add_argument("--name", help="suite name, the current time by default")
+    parser.add_argument("--refresh-cache", help="discover the device again instead of using the cached points", action='store_true')
+    parser.add_argument("--continue-on-failure", help="run all steps of every script and save the results of every check", action='store_true')
+
+    args = parser.parse_args()
+
+    suite = Suite(config_file=args.config, refresh_cache=args.refresh_cache)
+    suite.run(to_csv=args.csv, name=args.name or time.strftime("%Y%m%dT%H%M%S"), continue_on_failure=args.continue_on_failure or None)
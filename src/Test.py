@@ -1,33 +1,125 @@
 import yaml
 import json
+import hashlib
+import os
 import pandas as pd
+from src.AtomicFile import write_atomic
+from src.AsyncDevice import AsyncDevice
+from src.Clock import PeriodicDeadline, get_clock
 from src.Device import Device
+from src.Expression import Expression
+from src.Metrics import Metrics, MetricsServer, Timer
+from src.OverrideEngine import OverrideEngine
+from src.PlanCache import PlanCache
+from src.PointRegistry import PointRegistry, compare, to_number
+from src.SettleEngine import SettleEngine
+from src.SimulatedDevice import SimulatedDevice
+from src.TestPlan import TestPlan, ExpressionInput, RampInput, PeriodicInput, ExpressionCheck, LastCheck
+from src.TrendCapture import TrendCapture
+from src.TrendLogger import TrendLogger
+from src.ValueCache import ValueCache
 import time
 import argparse
-import re
-import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 class Test:
-    def __init__(self, config_file="config.yaml", device_init=True):
+    def __init__(self, config_file="config.yaml", device_init=True, device_config=None, network=None, rate_limiter=None, clock=None,
+                 refresh_cache=False, test_config=None, controller=None, registry=None):
+        '''
+        :param config_file: config file name in src/
+        :param device_init: connect to the device and load the test script
+        :param device_config: overrides of the device section of the config, e.g. one entry of the devices list
+        :param network: shared BAC0 network, connects a new one if None
+        :param rate_limiter: RateLimiter of the device's trunk
+        :param clock: Clock used for all timing, by default set by the clock entry of the test config
+        :param refresh_cache: discover the device again instead of using its cached point properties
+        :param test_config: overrides of the test section of the config, e.g. one entry of the suite list
+        :param controller: Device or SimulatedDevice already connected, e.g. by an earlier test of a suite
+        :param registry: PointRegistry of controller for the point map of the test, built from the point map if None
+        '''
         self.FILE_FOLDER = "./files/"
         self.SRC_FOLDER = "./src/"
 
         with open(self.SRC_FOLDER+config_file, "r") as fp:
             self.config = yaml.safe_load(fp)
 
+        if test_config is not None:
+            self.config["test"] = dict(self.config.get("test") or {}, **test_config)
         self.test_config = self.config["test"]
         self.test_file = self.test_config["test_script"]
         self.input_points_header = self.test_config.get("input_points_header", "Simulation (controller) Inputs")
         self.conditions_header = self.test_config.get("conditions_header", "Result Time")
         self.output_points_header = self.test_config.get("output_points_header", "Expected Controller BACnet Outputs")
+        self.condition_poll_interval = self.test_config.get("condition_poll_interval", 1)
+        self.use_cov = self.test_config.get("use_cov", True)
+        # predicates the controller has to meet after a reset, see src/SettleEngine.py
+        self.settle_config = dict(self.test_config.get("settle") or {})
+        self.settle_between_steps = self.settle_config.pop("between_steps", False)
+        # record failed checks and run all steps instead of stopping at the first failure
+        self.continue_on_failure = self.test_config.get("continue_on_failure", False)
+        self.trend_format = self.test_config.get("trend_format", "csv")
+        # minute logs and step end values read only the points the step uses unless log_all_points is set
+        self.log_all_points = self.test_config.get("log_all_points", False)
+        self.trend_loggers = {}
+
+        # high-rate capture of all points, capture_rate in samples per second, off if not set
+        self.capture_rate = self.test_config.get("capture_rate")
+        self.capture_buffer_size = self.test_config.get("capture_buffer_size", 3600)
+        self.capture_chunk_size = self.test_config.get("capture_chunk_size", 600)
+        self.trend_capture = None
+
+        # hot path metrics, per step in self.step_metrics and for the whole run in files/<name>_metrics.json
+        # a controller reused from an earlier test keeps recording to the metrics of that test
+        self.metrics = controller.metrics if controller is not None else Metrics(enabled=self.test_config.get("metrics", True))
+        self.step_metrics = []
+        self.metrics_server = None
+
+        if clock is None:
+            clock = get_clock(name=self.test_config.get("clock"), speedup=self.test_config.get("clock_speedup"))
+        self.clock = clock
+
+        # set from the BACnet thread when a COV notification for the condition variable arrives
+        self.cov_event = threading.Event()
+        self.cov_value = None
+        self.condition_latency = None
 
         if device_init:
-            self.controller = Device(device_config=self.config["device"])
+            if device_config is not None:
+                self.config["device"] = dict(self.config.get("device") or {}, **device_config)
 
             self.map_file = self.test_config["point_map"]
-            self.init_device(mapping_file=self.map_file)
+            if controller is not None:
+                self.controller = controller
+            elif self.config["device"].get("simulated"):
+                self.controller = SimulatedDevice(device_config=self.config["device"], clock=self.clock, point_map=self.map_file,
+                                                  metrics=self.metrics)
+            else:
+                # the asyncio backend sends the requests of one read or write together, see src/AsyncDevice.py
+                device_class = AsyncDevice if self.config["device"].get("backend") == "async" else Device
+                self.controller = device_class(device_config=self.config["device"], network=network, rate_limiter=rate_limiter,
+                                               refresh_cache=refresh_cache, metrics=self.metrics)
+
+            # repeated reads of a point within value_cache_ttl seconds are served without a request
+            self.value_cache = ValueCache(read_data=self.controller.read_data, clock=self.clock,
+                                          ttl=self.test_config.get("value_cache_ttl", 0.5))
+            self.overrides = OverrideEngine(controller=self.controller, clock=self.clock, evaluate_expression=self.evaluate_expression,
+                                            max_write_rate=self.config["device"].get("max_write_rate"), metrics=self.metrics)
+            # with the async backend the ramp / periodic writes of a tick run on this thread while the test loop reads the
+            # capture sample and the condition, so both are in flight on the device loop at the same time
+            self.io_executor = ThreadPoolExecutor(max_workers=1) if isinstance(self.controller, AsyncDevice) else None
+
+            if registry is not None:
+                self.registry = registry
+                self.points = {}
+            else:
+                self.init_device(mapping_file=self.map_file)
+            # only --reset, suites and between_steps wait for the controller to settle, see get_settle_engine
+            self.settle_engine = None
+            if self.settle_between_steps:
+                self.get_settle_engine()
 
-            self.init_test_sequence(filename=self.test_file, ip_header=self.input_points_header, cond_header=self.conditions_header, op_header=self.output_points_header, point_prop=self.point_properties)
+            self.init_test_sequence(filename=self.test_file, ip_header=self.input_points_header, cond_header=self.conditions_header, op_header=self.output_points_header, registry=self.registry)
 
     def init_device(self, mapping_file):
         with open(self.FILE_FOLDER+mapping_file, "r") as fp:
@@ -37,478 +129,714 @@ class Test:
         self.mapping.index.name = 'bacnet_name'
         self.point_properties = self.controller.get_point_properties()
         self.point_properties = pd.merge(left=self.point_properties, right=self.mapping, how='inner', left_index=True, right_index=True)
-        object_list = self.point_properties.apply(lambda x: (x['type'], x['address']), axis=1).values.tolist()
+
+        missing = set(self.mapping.index) - set(self.point_properties.index)
+        if missing:
+            print("WARNING: points of the point map not found on the device: %s" % ", ".join(sorted(missing)))
+
+        self.registry = PointRegistry(point_properties=self.point_properties, device_address=self.controller.device_address)
+        object_list = [(point.type, point.instance) for point in self.registry.points.values()]
         self.controller.reset_device(object_list = object_list)
         self.points = {}
 
-    def init_test_sequence(self, filename, ip_header, cond_header, op_header, point_prop):
-        self.test_df = pd.read_excel(self.FILE_FOLDER+filename, index_col=0, header=None)
-        self.ip = self.format_excel_df(df=self.test_df.loc[ip_header:cond_header].iloc[1:-1], point_prop=point_prop)
-        self.cond = self.format_excel_df(df=self.test_df.loc[cond_header:op_header].iloc[1:-1], is_cond_df=True, point_prop=point_prop)
-        self.op = self.format_excel_df(df=self.test_df.loc[op_header:].iloc[1:], point_prop=point_prop)
-        self.acceptable_op_bounds = self.op.loc["acceptable_bounds"]
+    def init_test_sequence(self, filename, ip_header, cond_header, op_header, registry, use_cache=None):
+        '''
+        Load the TestPlan of the test script, from the plan cache next to the script while the script and the point map are unchanged
+        :param use_cache: use and update the plan cache, plan_cache of the test config if None
+        '''
+        if use_cache is None:
+            use_cache = self.test_config.get("plan_cache", True)
+
+        self.expressions = {}
+        self.plan = None
+        if use_cache:
+            plan_cache = PlanCache(folder=self.FILE_FOLDER)
+            key = plan_cache.get_key(script_hash=self.get_script_hash(filename=filename), test_to_bacnet=registry.test_to_bacnet,
+                                     headers=(ip_header, cond_header, op_header))
+            self.plan = plan_cache.load(script_file=filename, key=key, compile_expression=self.compile_expression)
+
+        if self.plan is None:
+            ip, cond, op = self.read_test_script(filename=filename, ip_header=ip_header, cond_header=cond_header,
+                                                 op_header=op_header, registry=registry)
+            # parse and validate every cell once; the test loop only works on the compiled steps
+            self.plan = TestPlan(ip=ip, cond=cond, op=op, compile_expression=self.compile_expression)
+            if use_cache:
+                # the cache only saves time, e.g. another test of the Runner may be saving the same plan
+                try:
+                    plan_cache.save(script_file=filename, key=key, plan=self.plan)
+                except Exception as e:
+                    print("WARNING: could not save the test plan cache of %s: %s" % (filename, e))
 
         self.current_step = None
+        # seconds taken to write the inputs of the last step
+        self.apply_time = None
         self.step_outputs = {}
-
-        self.ramp_step = False
-        self.ramp_variables = {}
-
-        self.periodic_step = False
-        self.periodic_variables = {}
-
-    def format_excel_df(self, df, is_cond_df=False, point_prop=None):
-        df_new = df.reset_index().drop([0, 1], axis=1)
-        cols = ['step%d' % i for i in range(len(df_new.columns) - 2)]
-        cols = ['variable_name', 'acceptable_bounds'] + cols
-        df_new.columns = cols
-
+        # step number: {test variable name: result of its check}, and the failed checks in the order they happened
+        self.results = {}
+        self.failures = []
+
+    def read_test_script(self, filename, ip_header, cond_header, op_header, registry):
+        '''
+        :return: inputs, conditions and outputs DataFrames of the test script
+        '''
+        test_df = pd.read_excel(self.FILE_FOLDER+filename, index_col=0, header=None)
+
+        # row positions of the section headers, found in one pass over the first column
+        headers = (ip_header, cond_header, op_header)
+        positions = {}
+        for position, label in enumerate(test_df.index):
+            if label in headers and label not in positions:
+                positions[label] = position
+        missing = [header for header in headers if header not in positions]
+        if missing:
+            raise Exception("section header %s not found in test script %s" % (", ".join(missing), filename))
+
+        ip = self.format_excel_df(df=test_df.iloc[positions[ip_header] + 1:positions[cond_header]], registry=registry)
+        cond = self.format_excel_df(df=test_df.iloc[positions[cond_header] + 1:positions[op_header]], is_cond_df=True, registry=registry)
+        op = self.format_excel_df(df=test_df.iloc[positions[op_header] + 1:], registry=registry)
+        return ip, cond, op
+
+    def format_excel_df(self, df, is_cond_df=False, registry=None):
+        '''
+        :param df: rows of one section of the script: description, variable name, acceptable bounds, then one column per step
+        :return: DataFrame with one row per step (and the acceptable_bounds row), one column per variable
+        '''
+        names = df.iloc[:, 1]
         if not is_cond_df:
-            df_new['variable_name'] = df_new['variable_name'].map(lambda x: point_prop.loc[point_prop['name_in_test'] == x].name[0])
-            return df_new.set_index('variable_name').T
-        else:
-            df_new = df_new.set_index('variable_name').T
-            df_new.loc[df_new['or'] == 1, 'VariableName'] = df_new.loc[df_new['or'] == 1, 'VariableName'].map(lambda x: point_prop.loc[point_prop["name_in_test"] == x].name[0])
+            names = names.map(registry.to_bacnet)
+        index = ['acceptable_bounds'] + ['step%d' % i for i in range(df.shape[1] - 3)]
+        # a single transposed copy of the cells
+        df_new = pd.DataFrame(df.iloc[:, 2:].to_numpy(dtype=object).T, index=index,
+                              columns=pd.Index(names.to_numpy(), name='variable_name'), dtype=object)
+
+        if is_cond_df:
+            df_new.loc[df_new['or'] == 1, 'VariableName'] = df_new.loc[df_new['or'] == 1, 'VariableName'].map(registry.to_bacnet)
             time_vals = df_new.loc[df_new['ClkTime'].notnull()].index
             cond_time = pd.to_datetime(df_new.loc[time_vals, 'ClkTime'], format="%H:%M:%S")
             df_new.loc[time_vals, 'ClkTime'] = cond_time.dt.hour * 3600 + cond_time.dt.minute * 60 + cond_time.dt.second
-            return df_new
+        return df_new
 
-    def read_points(self):
-        for point in sorted(self.point_properties.name.values):
-            var_name_in_test = self.point_properties.loc[point].name_in_test
-            self.points[var_name_in_test] = self.controller.device[point].value
+    def compile_expression(self, expression):
+        expression = expression.replace(" ", "")
+        if expression.startswith("="):
+            expression = expression[1:]
+        if expression not in self.expressions:
+            self.expressions[expression] = Expression(expression=expression, resolve_name=self.resolve_test_name)
+        return self.expressions[expression]
+
+    def resolve_test_name(self, name):
+        return self.registry.find_bacnet_name(name)
+
+    def read_points(self, values=None):
+        '''
+        :param values: snapshot of bacnet point name: value of all mapped points, read from the device if None
+        :return: dictionary of test variable name: value
+        '''
+        if values is None:
+            values = self.value_cache.read_data(points_to_read=self.registry.names)
+        for point in values:
+            var_name_in_test = self.registry.to_test(point)
+            self.points[var_name_in_test] = values[point]
         return self.points
 
-    def print_points(self, to_csv=False, name=None):
-        points = self.read_points()
+    def get_trend_logger(self, name, kind, columns, column_types):
+        file = self.FILE_FOLDER + name + "_" + kind + "." + self.trend_format
+        if file not in self.trend_loggers:
+            self.trend_loggers[file] = TrendLogger(filename=file, columns=columns, column_types=column_types, file_format=self.trend_format)
+        return self.trend_loggers[file]
+
+    def close_trend_loggers(self):
+        for trend_logger in self.trend_loggers.values():
+            trend_logger.close()
+        self.trend_loggers = {}
+
+    def print_points(self, to_csv=False, name=None, values=None):
+        '''
+        :param values: snapshot of bacnet point name: value the test already read, all points are read if None;
+                       only the points of the snapshot are printed and logged
+        '''
+        if values is None:
+            values = self.value_cache.read_data(points_to_read=self.registry.names)
+        self.read_points(values=values)
+        points = {self.registry.to_test(point): values[point] for point in values}
         for k in sorted(points):
             print("%s: %s" % (k, str(points[k])))
         print()
 
         if to_csv:
-            file = self.FILE_FOLDER + name + "_values.csv"
-            if not os.path.exists(file):
-                fp = open(file, "w")
-                column_names = 'time,' + ','.join(list(points.keys())) + '\n'
-                fp.write(column_names)
-            else:
-                fp = open(file, "a")
-            values = time.strftime("%Y-%m-%d %H:%M:%S")+','+','.join([str(value) for value in points.values()])+'\n'
-            fp.write(values)
+            # fixed schema: time, then the test names of all mapped points in alphabetical order
+            names = sorted(self.registry.test_to_bacnet)
+            column_types = ['str'] + ['str' if 'binary' in str(self.registry.get(self.registry.to_bacnet(var)).type) else 'float' for var in names]
+            trend_logger = self.get_trend_logger(name=name, kind="values", columns=['time'] + names, column_types=column_types)
+
+            row = dict(points)
+            row['time'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.clock.time()))
+            trend_logger.log(row)
 
     def save_test_times(self, to_csv=False, name=None, step=None, st=None, et=None, duration=None):
         if to_csv:
-            file = self.FILE_FOLDER + name + "_test_times.csv"
-            if not os.path.exists(file):
-                fp = open(file, "w")
-                column_names = 'step,start_time,end_time,duration\n'
-                fp.write(column_names)
-            else:
-                fp = open(file, "a")
-
-            values = "%d,%f,%f,%f\n"%(step, st, et, duration)
-            fp.write(values)
+            trend_logger = self.get_trend_logger(name=name, kind="test_times", columns=['step', 'start_time', 'end_time', 'duration'],
+                                                 column_types=['int', 'float', 'float', 'float'])
+            trend_logger.log([step, st, et, duration])
+
+    def reset(self):
+        '''
+        Apply the inputs of the first step and wait for the controller to settle
+        '''
+        # check the settle predicates before writing anything
+        self.get_settle_engine()
+        print("resetting points")
+        self.set_values(inputs=self.plan.steps[0].inputs)
+        self.settle()
+
+    def relinquish(self):
+        '''
+        Release all inputs of the test script at the write priority of the test
+        :return: dictionary of bacnet point name: True if relinquished
+        '''
+        print("relinquishing inputs")
+        results = self.controller.write_values(point_value_dict={point: None for point in self.plan.input_points})
+        # the test no longer commands these values, the next write of each input must not be skipped as unchanged
+        relinquished = [point for point in results if results[point]]
+        self.overrides.forget(points=relinquished)
+        self.value_cache.invalidate(points=relinquished)
+        return results
+
+    def get_settle_engine(self):
+        # created on first use, so that a point map without the settle variables only matters to the runs that settle
+        if self.settle_engine is None:
+            self.settle_engine = SettleEngine(controller=self.controller, registry=self.registry, clock=self.clock, **self.settle_config)
+        return self.settle_engine
+
+    def settle(self, timeout=None):
+        '''
+        Wait until the settle predicates of the config hold
+        :param timeout: seconds to wait, the timeout of the settle config if None
+        '''
+        if not self.get_settle_engine().wait(timeout=timeout):
+            raise Exception("controller did not settle, see the settle predicates of the config")
+        print()
 
-    def start_test(self, to_csv=False, name=None):
-        output_acceptable_bounds = self.acceptable_op_bounds.to_dict()
-        start_time = time.time()
-        for i in range(1, self.ip.shape[0]):
+    def start_test(self, to_csv=False, name=None, resume=False, continue_on_failure=None):
+        '''
+        :param name: test name of the log files and of the checkpoint saved after every completed step
+        :param resume: continue after the last completed step of the checkpoint of the test name, if there is one
+        :param continue_on_failure: run all steps and record every failed check, continue_on_failure of the config if None
+        '''
+        if continue_on_failure is not None:
+            self.continue_on_failure = continue_on_failure
+
+        checkpoint = None
+        if resume and name:
+            checkpoint = self.load_checkpoint(name=name)
+            if checkpoint is None:
+                print("no checkpoint found for %s, starting from the first step" % name)
+
+        # the port can be set per device, e.g. in the devices list of src/Runner.py
+        metrics_port = (self.config.get("device") or {}).get("metrics_port") or self.test_config.get("metrics_port")
+        if metrics_port and self.metrics.enabled:
+            try:
+                self.metrics_server = MetricsServer(metrics=self.metrics, port=int(metrics_port))
+                print("serving metrics at http://127.0.0.1:%s/metrics" % metrics_port)
+            except OSError as e:
+                print("WARNING: could not serve metrics at port %s: %s" % (metrics_port, e))
+
+        if self.capture_rate:
+            file_prefix = self.FILE_FOLDER + name + "_capture" if name else None
+            self.trend_capture = TrendCapture(points=self.registry.names, read_data=self.value_cache.refresh, clock=self.clock,
+                                              rate=self.capture_rate, buffer_size=self.capture_buffer_size,
+                                              chunk_size=self.capture_chunk_size, file_prefix=file_prefix,
+                                              append=checkpoint is not None)
+        try:
+            return self.run_test(to_csv=to_csv, name=name, checkpoint=checkpoint)
+        finally:
+            self.close_trend_loggers()
+            if self.trend_capture is not None:
+                self.trend_capture.close()
+            if to_csv and self.metrics.enabled:
+                self.save_metrics(name=name)
+            if name and (to_csv or self.continue_on_failure):
+                self.save_results(name=name)
+            if self.metrics_server is not None:
+                self.metrics_server.close()
+                self.metrics_server = None
+
+    def save_metrics(self, name):
+        with open(self.FILE_FOLDER + name + "_metrics.json", "w") as fp:
+            json.dump({'steps': self.step_metrics, 'totals': self.metrics.to_dict()}, fp, indent=2)
+
+    def save_results(self, name):
+        '''
+        Save the results matrix of the run: files/<name>_results.json with the details of every check and
+        files/<name>_results.csv with one row per step and one column per output, pass / fail or empty if not checked
+        '''
+        variables = sorted(set(variable for step_results in self.results.values() for variable in step_results))
+        with open(self.FILE_FOLDER + name + "_results.json", "w") as fp:
+            json.dump({'test_script': self.test_file, 'passed': not self.failures, 'outputs': variables,
+                       'steps': {str(step): self.results[step] for step in sorted(self.results)}, 'failures': self.failures},
+                      fp, indent=2, default=str)
+
+        rows = []
+        for step in sorted(self.results):
+            row = {'step': step}
+            for variable in variables:
+                result = self.results[step].get(variable)
+                row[variable] = "" if result is None else ("pass" if result['passed'] else "fail")
+            rows.append(row)
+        pd.DataFrame(rows, columns=['step'] + variables).to_csv(self.FILE_FOLDER + name + "_results.csv", index=False)
+        print("results saved to %s_results.json and %s_results.csv" % (self.FILE_FOLDER + name, self.FILE_FOLDER + name))
+
+    def record_step_metrics(self, step, since, duration):
+        '''
+        :param since: metrics snapshot taken when the step started
+        :param duration: seconds the step took on the test clock
+        '''
+        if not self.metrics.enabled:
+            return
+        step_metrics = {'step': step, 'duration': duration, 'apply_time': self.apply_time, 'condition_latency': self.condition_latency}
+        step_metrics.update(self.metrics.get_step_metrics(since=since))
+        self.step_metrics.append(step_metrics)
+
+        def ms(value):
+            return "-" if value is None else "%.1f ms" % (value * 1000)
+        print("step %d metrics: %d reads (mean %s, max %s), %d writes (mean %s), %d expression evaluations (mean %s), "
+              "%d condition checks%s, ramp jitter max %s" % (
+              step, step_metrics['read_count'], ms(step_metrics['read_mean']), ms(step_metrics['read_max']),
+              step_metrics['write_count'], ms(step_metrics['write_mean']), step_metrics['expression_count'],
+              ms(step_metrics['expression_mean']), step_metrics['condition_iterations'],
+              "" if step_metrics['condition_iterations_per_second'] is None else " (%.1f/s)" % step_metrics['condition_iterations_per_second'],
+              ms(step_metrics['ramp_jitter_max'])))
+
+    def get_checkpoint_file(self, name):
+        return self.FILE_FOLDER + name + "_checkpoint.json"
+
+    def get_script_hash(self, filename=None):
+        with open(self.FILE_FOLDER + (filename or self.test_file), "rb") as fp:
+            return hashlib.sha256(fp.read()).hexdigest()
+
+    def save_checkpoint(self, name, step, start_time, elapsed):
+        '''
+        Save the progress of the test after a completed step
+        :param step: number of the completed step
+        :param start_time: wall clock time the test started
+        :param elapsed: seconds the test has run so far
+        '''
+        checkpoint = {'test_script': self.test_file, 'script_hash': self.script_hash, 'step': step,
+                      'step_outputs': self.step_outputs[step], 'start_time': start_time, 'elapsed': elapsed,
+                      'results': self.results, 'failures': self.failures, 'step_metrics': self.step_metrics}
+        write_atomic(self.get_checkpoint_file(name), json.dumps(checkpoint, indent=2, default=str))
+
+    def load_checkpoint(self, name):
+        filename = self.get_checkpoint_file(name)
+        if not os.path.exists(filename):
+            return None
+        with open(filename, "r") as fp:
+            checkpoint = json.load(fp)
+        if checkpoint['test_script'] != self.test_file or checkpoint['script_hash'] != self.get_script_hash():
+            raise Exception("checkpoint %s was saved for a different test script" % filename)
+        return checkpoint
+
+    def resume(self, checkpoint, to_csv=False, name=None):
+        '''
+        Bring the controller back to the state at the end of the last completed step of the checkpoint:
+        apply the inputs of that step again and wait for its condition
+        :return: index in self.plan.steps of the step to continue with
+        '''
+        step = self.plan.steps[checkpoint['step'] - 1]
+        print("resuming after step %d: applying its inputs again and waiting for the controller to settle" % step.number)
+        self.current_step = step.number
+        self.set_values(inputs=step.inputs)
+        self.test_conditions(condition=step.condition, st=self.clock.monotonic(), to_csv=to_csv, name=name,
+                             log_points=self.get_log_points(step))
+
+        # "last" comparisons of the next step use the outputs recorded before the interruption
+        self.step_outputs[step.number] = checkpoint['step_outputs']
+        # json keys are strings
+        self.results = {int(number): step_results for number, step_results in checkpoint.get('results', {}).items()}
+        self.failures = checkpoint.get('failures', [])
+        # files/<name>_metrics.json of the resumed test also holds the steps before the interruption
+        self.step_metrics = checkpoint.get('step_metrics', []) + self.step_metrics
+        print("resuming the test at step %d" % (step.number + 1))
+        print()
+        return step.number
+
+    def run_test(self, to_csv=False, name=None, checkpoint=None):
+        start_time = self.clock.time()
+        start_monotonic = self.clock.monotonic()
+        if name:
+            self.script_hash = self.get_script_hash()
+
+        first_step = 0
+        if checkpoint is not None:
+            first_step = self.resume(checkpoint=checkpoint, to_csv=to_csv, name=name)
+            # total times include the time before the interruption
+            start_time = checkpoint['start_time']
+            start_monotonic -= checkpoint['elapsed']
+
+        for step in self.plan.steps[first_step:]:
+            i = step.number
+            if self.settle_between_steps and i > 1:
+                self.settle()
             self.current_step = i
             print("starting step %d"%i)
+            metrics_start = self.metrics.start_step()
 
-            ip = self.ip.iloc[i].to_dict()
-            cond = self.cond.iloc[i]
-            expected_op = self.op.iloc[i].to_dict()
-
-            # self.controller.set_values(point_value_dict = ip)
-            self.set_values(variable_value_dict=ip)
+            # the variables of all input expressions of the step in one read
+            if step.dependencies.inputs:
+                self.value_cache.refresh(points_to_read=step.dependencies.inputs)
+            self.set_values(inputs=step.inputs)
             print("Successfully set input values=================================")
             print()
 
-            step_start_time = time.time()
-            self.test_conditions(condition=cond, st=step_start_time, to_csv=to_csv, name=name)
+            step_start_time = self.clock.time()
+            step_start_monotonic = self.clock.monotonic()
+            log_points = self.get_log_points(step)
+            self.test_conditions(condition=step.condition, st=step_start_monotonic, to_csv=to_csv, name=name, log_points=log_points)
+            # one snapshot of the points of the step for the log and the output checks
+            snapshot = self.value_cache.refresh(points_to_read=log_points)
+            print("input writes so far: %(issued)d issued, %(skipped)d skipped as unchanged, %(failed)d failed" % self.overrides.get_counters())
+            print("point reads so far: %(hits)d served from the cache, %(misses)d read from the device" % self.value_cache.get_counters())
             print("Conditions met. Current values = ")
-            self.print_points(to_csv=to_csv, name=name)
+            self.print_points(to_csv=to_csv, name=name, values=snapshot)
 
-            actual_outputs = self.get_current_variable_values(variable_list = self.op.columns.values)
+            actual_outputs = {var: snapshot[var] for var in self.plan.output_points}
             self.step_outputs[self.current_step] = actual_outputs
 
             if i > 1:
                 print("Checking if outputs match the expected values")
-                assertion_op = self.assert_output(expected_op_dict = expected_op, actual_output_dict=actual_outputs, acceptable_bounds_dict = output_acceptable_bounds)
-                if not assertion_op:
-                    end_time = time.time()
-                    time_elapsed = round((end_time - start_time)/60, 2)
+                assertion_op = self.assert_output(checks=step.outputs, actual_output_dict=actual_outputs,
+                                                  stop_on_failure=not self.continue_on_failure)
+                if not assertion_op and self.continue_on_failure:
+                    print("Failed step %d, continuing with the next step" % i)
+                    self.save_test_times(to_csv=to_csv, name=name, step=i, st=step_start_time, et=self.clock.time(),
+                                         duration=round((self.clock.monotonic() - step_start_monotonic)/60, 2))
+                elif not assertion_op:
+                    end_time = self.clock.time()
+                    time_elapsed = round((self.clock.monotonic() - start_monotonic)/60, 2)
                     print("Test failed! Total time = %f minutes"%round(time_elapsed, 2))
+                    if self.trend_capture is not None:
+                        self.trend_capture.spill()
+                        print("failed at %f (%s); high-rate capture saved to %s_*.npz" % (
+                            end_time, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(end_time)), self.trend_capture.file_prefix))
                     self.save_test_times(to_csv=to_csv, name=name, step=-1, st=start_time, et=end_time,
                                          duration=time_elapsed)
+                    self.record_step_metrics(step=i, since=metrics_start, duration=self.clock.monotonic() - step_start_monotonic)
 
-                    return
-                step_end_time = time.time()
-                step_time_elapsed = round((step_end_time - step_start_time)/60, 2)
-                print("Passed step %d; Time taken for this step = %f minutes"%(i, round(step_time_elapsed, 2)))
-                self.save_test_times(to_csv=to_csv, name=name, step=i, st=step_start_time, et=step_end_time, duration=step_time_elapsed)
+                    return False
+                else:
+                    step_end_time = self.clock.time()
+                    step_time_elapsed = round((self.clock.monotonic() - step_start_monotonic)/60, 2)
+                    print("Passed step %d; Time taken for this step = %f minutes"%(i, round(step_time_elapsed, 2)))
+                    self.save_test_times(to_csv=to_csv, name=name, step=i, st=step_start_time, et=step_end_time, duration=step_time_elapsed)
 
             else:
                 print("not checking first step values")
+            self.record_step_metrics(step=i, since=metrics_start, duration=self.clock.monotonic() - step_start_monotonic)
+            if name:
+                self.save_checkpoint(name=name, step=i, start_time=start_time, elapsed=self.clock.monotonic() - start_monotonic)
 
             print("moving to the next step")
             print()
-        end_time = time.time()
-        time_elapsed = round((end_time - start_time) / 60, 2)
+        end_time = self.clock.time()
+        time_elapsed = round((self.clock.monotonic() - start_monotonic) / 60, 2)
+        if name and os.path.exists(self.get_checkpoint_file(name)):
+            os.remove(self.get_checkpoint_file(name))
+        if self.failures:
+            failed_steps = sorted(set(failure['step'] for failure in self.failures))
+            print("Test failed! %d failed checks in steps %s. Total time = %f minutes" % (
+                len(self.failures), ", ".join(str(step) for step in failed_steps), round(time_elapsed, 2)))
+            self.save_test_times(to_csv=to_csv, name=name, step=-1, st=start_time, et=end_time, duration=time_elapsed)
+            return False
         print("Controller passed the test successfully! Total time = %f minutes"%round(time_elapsed, 2))
         self.save_test_times(to_csv=to_csv, name=name, step=999, st=start_time, et=end_time,
                              duration=time_elapsed)
-        return
-
-    def set_values(self, variable_value_dict):
-        # start with assumption that there are no ramping variables in this step
-        self.ramp_step = False
-        self.ramp_variables = {}
-
-        self.periodic_step = False
-        self.periodic_variables = {}
-
-        for key in variable_value_dict:
-            val = variable_value_dict[key]
-            if type(val) == str:
-                # remove all whitespaces
-                val = val.replace(" ","")
-
-                if val.startswith("ramp("):
-                    ramp_params_dict = self.get_ramp_parameter_dict(val=val)
-                    self.ramp_variables[key] = ramp_params_dict
-                    value_to_set = ramp_params_dict['ramp_start']
-                elif val.startswith("periodic("):
-                    periodic_params_dict = self.get_periodic_parameter_dict(val=val)
-                    self.periodic_variables[key] = periodic_params_dict
-                    value_to_set = periodic_params_dict['periodic_start']
-                elif val.startswith("="):
-                    expression = val[1:]
-                    value_to_set = self.evaluate_expression(expression=expression)
-                else:
-                    if val.lower() in ['open', 'present', 'on']:
-                        value_to_set = 'active'
-                    elif val.lower() in ['closed', 'absent', 'off']:
-                        value_to_set = 'inactive'
-                    else:
-                        value_to_set = val
+        return True
+
+    def get_log_points(self, step):
+        '''
+        :return: points read for the logs of a step: the points it depends on and all outputs, which the "last"
+                 checks of the next step compare against, or all points if log_all_points is set
+        '''
+        if self.log_all_points:
+            return self.registry.names
+        return sorted(set(step.dependencies.all) | set(self.plan.output_points))
+
+    def set_values(self, inputs):
+        '''
+        :param inputs: input actions of a step of the TestPlan
+        '''
+        # ramps and periodic updates of the previous step stop here
+        self.overrides.clear()
+
+        values = {}
+        for action in inputs:
+            key = action.point
+            if isinstance(action, RampInput):
+                # start and end expressions are evaluated once, when the step starts
+                ramp_start, ramp_end = [self.evaluate_expression(expression=param) if isinstance(param, Expression) else param
+                                        for param in [action.start, action.end]]
+                self.overrides.add_ramp(point=key, start=ramp_start, end=ramp_end, rate=action.rate, period=action.period)
+                value_to_set = ramp_start
+            elif isinstance(action, PeriodicInput):
+                self.overrides.add_periodic(point=key, expression=action.expression, period=action.period)
+                value_to_set = self.evaluate_expression(expression=action.expression)
+            elif isinstance(action, ExpressionInput):
+                value_to_set = self.evaluate_expression(expression=action.expression)
             else:
                 # TODO: handle units == 'percent'
-                value_to_set = val
-            var_name_in_test = self.point_properties.loc[key].name_in_test
+                value_to_set = action.value
+            var_name_in_test = self.registry.to_test(key)
             print("Setting input %s to %s"%(var_name_in_test, value_to_set))
-            self.controller.device[key] = value_to_set
-
-    def get_ramp_parameter_dict(self, val, default_ramp_period=10):
-        val = val.split("ramp(")[1][:-1]
-        string_parameters = val.split(';')
-        ramp_params = []
-        for param in string_parameters:
-            if param.startswith("="):
-                expression = param[1:]
-                val_expression = self.evaluate_expression(expression=expression)
-                ramp_params.append(val_expression)
-            else:
-                ramp_params.append(float(param))
-
-        ramp_params_dict = {}
-
-        # if start == end, no ramping
-        if ramp_params[0] != ramp_params[1]:
-            self.ramp_step = True
-
-        ramp_params_dict['ramp_start'] = ramp_params[0]
-        ramp_params_dict['ramp_end'] = ramp_params[1]
-
-        # convert ramp rate to value per second
-        ramp_params_dict['ramp_rate'] = ramp_params[2]/60.0
-
-        if len(ramp_params) == 4:
-            ramp_params_dict['ramp_period'] = ramp_params[3]
-        else:
-            ramp_params_dict['ramp_period'] = default_ramp_period
-
-        return ramp_params_dict
-
-    def get_periodic_parameter_dict(self, val, default_period = 10):
-        val = val.split("periodic(")[1][:-1]
-        string_parameters = val.split(";")
-        periodic_params = []
-        for param in string_parameters:
-            if param.startswith("="):
-                periodic_params.append(param[1:])
-            else:
-                periodic_params.append(float(param))
-
-        self.periodic_step = True
-
-        periodic_params_dict = {}
-        periodic_params_dict['periodic_start'] = self.evaluate_expression(expression=periodic_params[0])
-        periodic_params_dict['periodic_expression'] = periodic_params[0]
-        if len(periodic_params) == 2:
-            periodic_params_dict['period'] = int(periodic_params[1])
-        else:
-            periodic_params_dict['period'] = default_period
-
-        return periodic_params_dict
-
-    def set_ramp_value(self, variable, params, seconds_since_start):
-        ramp_start = params['ramp_start']
-        ramp_end = params['ramp_end']
-        ramp_rate = params['ramp_rate']
-        ramp_period = params['ramp_period']
-
-        if seconds_since_start % ramp_period == 0:
-            current_period = seconds_since_start / ramp_period
-            if ramp_start < ramp_end:
-                value_to_set = ramp_start + ramp_rate * current_period * ramp_period
-                if value_to_set > ramp_end:
-                    value_to_set = ramp_end
-            elif ramp_start > ramp_end:
-                value_to_set = ramp_start - ramp_rate * current_period * ramp_period
-                if value_to_set < ramp_end:
-                    value_to_set = ramp_end
-
-            current_value = self.controller.device[variable].value
-            if round(value_to_set, 2) != round(current_value, 2):
-                var_name_in_test = self.point_properties.loc[variable].name_in_test
-                print("Ramping input %s to %f" % (var_name_in_test, value_to_set))
-                print()
-                self.controller.device[variable] = value_to_set
-
-    def set_periodic_value(self, variable, params, seconds_since_start):
-        periodic_expression = params['periodic_expression']
-        period = params['period']
-
-        if seconds_since_start%period == 0:
-            value_to_set = self.evaluate_expression(expression=periodic_expression)
-            current_value = self.controller.device[variable].value
-            if round(value_to_set, 2) != round(current_value, 2):
-                var_name_in_test = self.point_properties.loc[variable].name_in_test
-                print("Periodic: Changing variable %s to %f" % (var_name_in_test, value_to_set))
-                print()
-                self.controller.device[variable] = value_to_set
-
-    def test_conditions(self, condition, st, sleep_interval=None, verbose=False, to_csv=False, name=None):
-
+            values[key] = value_to_set
+
+        # all inputs of the step are written together so that they change at (nearly) the same time
+        start_time = self.clock.monotonic()
+        results = self.overrides.write(values, force=True)
+        self.value_cache.invalidate(points=results)
+        self.apply_time = self.clock.monotonic() - start_time
+        print("applied %d inputs in %.3f seconds" % (len(values), self.apply_time))
+
+        failed = [self.registry.to_test(point) for point in results if not results[point]]
+        if failed:
+            raise Exception("failed to set inputs %s in step %s" % (", ".join(failed), self.current_step))
+
+    def on_condition_cov(self, point_name, value):
+        self.cov_value = (value, self.clock.monotonic())
+        self.cov_event.set()
+
+    def test_conditions(self, condition, st, poll_interval=None, verbose=False, to_csv=False, name=None, log_points=None):
+        '''
+        Wait until the step condition is met or ClkTime has passed, applying ramp and periodic updates meanwhile.
+        The loop sleeps until the next ramp/periodic tick, condition poll, log minute or deadline, and wakes up early
+        when a COV notification for the condition variable arrives
+        :param condition: Condition of the step
+        :param st: step start time on the monotonic clock of self.clock
+        :param poll_interval: seconds between two reads of the condition variable
+        :param log_points: points read for the log every minute, all points if None
+        '''
         print("step = %d " % self.current_step)
-        current_time = time.time()
-        last_print = None
-
-        while current_time - st <= condition['ClkTime']:
-
-            seconds_since_start = int(current_time - st)
-
-            if self.ramp_step:
-                for variable in self.ramp_variables:
-                    params = self.ramp_variables[variable]
-                    self.set_ramp_value(variable=variable, params=params, seconds_since_start=seconds_since_start)
-
-            if self.periodic_step:
-                for variable in self.periodic_variables:
-                    params = self.periodic_variables[variable]
-                    self.set_periodic_value(variable=variable, params=params, seconds_since_start=seconds_since_start)
-
-            if verbose:
-                print("current time = %f, wait until %f" % (current_time - st, condition['ClkTime']))
-
-            if condition['or'] == 1:
-                output_variable_to_check = condition['VariableName']
-                output_value_to_check = condition['VariableValue']
-
-                if type(output_value_to_check) == str:
-                    operator = re.findall("\A\D+", output_value_to_check)
-                    if len(operator) == 1:
-                        operator = operator[0]
-                    else:
-                        #TODO: handle this better
-                        raise Exception("Invalid condition value in step %d for variable %s"%(self.current_step, output_variable_to_check))
-
-                    output_value_to_check = output_value_to_check.split(operator)[1]
-                    if output_value_to_check.endswith("%"):
-                        output_value_to_check = float(output_value_to_check[:-1])/100
-                    else:
-                        output_value_to_check = float(output_value_to_check)
+        if poll_interval is None:
+            poll_interval = self.condition_poll_interval
+
+        deadline = st + condition.clk_time
+        check_condition = condition.variable is not None
+        cov_subscribed = False
+
+        self.cov_event.clear()
+        self.cov_value = None
+        self.condition_latency = None
+
+        if check_condition:
+            output_variable_to_check, operator, output_value_to_check = condition.variable, condition.operator, condition.value
+            if self.use_cov:
+                cov_subscribed = self.controller.subscribe_cov(point_name=output_variable_to_check, callback=self.on_condition_cov,
+                                                               lifetime=int(condition.clk_time) + 60)
+                if cov_subscribed:
+                    print("subscribed to COV notifications of %s" % output_variable_to_check)
+
+        next_poll = st
+        last_poll = None
+        print_deadline = PeriodicDeadline(start=st, period=60)
+        capture_deadline = None
+        if self.trend_capture is not None:
+            capture_deadline = PeriodicDeadline(start=st, period=self.trend_capture.period)
+
+        # ramp and periodic updates are deadline events every period seconds from the step start
+        self.overrides.start(st=st)
+
+        wait_start = time.perf_counter()
+        try:
+            current_time = self.clock.monotonic()
+            while current_time < deadline:
+                iteration_start = time.perf_counter()
+
+                pending_update = None
+                if self.io_executor is not None:
+                    pending_update = self.io_executor.submit(self.overrides.update, now=current_time)
                 else:
-                    operator = ">="
-
-                actual_output_variable_value = self.controller.device[output_variable_to_check].value
-
-                # handle percent values
-                if self.point_properties.loc[output_variable_to_check].units_state == 'percent':
-                    actual_output_variable_value = actual_output_variable_value/100
-
-                if self.evaluate_boolean_expression(operator=operator, actual_value=actual_output_variable_value, expected_value=output_value_to_check):
-                    print("condition satisfied, variable %s value %f %s condition value %f"%(output_variable_to_check, actual_output_variable_value, operator, output_value_to_check))
-                    print()
-                    return
-
-            if seconds_since_start%60 == 0:
-                if last_print == None or last_print != seconds_since_start/60:
-                    last_print = seconds_since_start/60
-                    print("Completed minute %d of step %d of the test; Current values=" % (int(seconds_since_start/60), self.current_step))
-                    self.print_points(to_csv=to_csv, name=name)
-
-            if sleep_interval:
-                time.sleep(sleep_interval)
-
-            current_time = time.time()
+                    self.report_updates(self.overrides.update(now=current_time))
+
+                if verbose:
+                    print("current time = %f, wait until %f" % (current_time - st, condition.clk_time))
+
+                capture_snapshot = None
+                if capture_deadline is not None and capture_deadline.due(current_time) is not None:
+                    capture_snapshot = self.trend_capture.sample()
+
+                actual_output_variable_value = None
+                if check_condition:
+                    if self.cov_event.is_set():
+                        self.cov_event.clear()
+                        actual_output_variable_value, changed_at = self.cov_value
+                        detected_by = "COV"
+                    elif current_time >= next_poll or capture_snapshot is not None:
+                        # a capture sample already holds the condition variable
+                        if capture_snapshot is not None:
+                            actual_output_variable_value = capture_snapshot[output_variable_to_check]
+                        else:
+                            actual_output_variable_value = self.value_cache.refresh(points_to_read=[output_variable_to_check])[output_variable_to_check]
+                        # the value changed at some point after the previous poll
+                        changed_at = last_poll if last_poll is not None else current_time
+                        detected_by = "polling"
+                        last_poll = current_time
+                        next_poll = current_time + poll_interval
+
+                if pending_update is not None:
+                    self.report_updates(pending_update.result())
+
+                if actual_output_variable_value is not None:
+                    actual_output_variable_value = self.registry.get(output_variable_to_check).normalize(actual_output_variable_value)
+                    if compare(operator, actual_output_variable_value, output_value_to_check):
+                        self.condition_latency = self.clock.monotonic() - changed_at
+                        print("condition satisfied, variable %s value %f %s condition value %f"%(output_variable_to_check, actual_output_variable_value, operator, output_value_to_check))
+                        print("condition detected by %s, detection latency %.3f seconds" % (detected_by, self.condition_latency))
+                        print()
+                        self.metrics.observe('condition_iteration_seconds', time.perf_counter() - iteration_start)
+                        return
+
+                minute = print_deadline.due(current_time)
+                if minute is not None:
+                    print("Completed minute %d of step %d of the test; Current values=" % (minute, self.current_step))
+                    self.print_points(to_csv=to_csv, name=name,
+                                      values=self.value_cache.read_data(points_to_read=log_points or self.registry.names))
+
+                # sleep until the next event, whichever comes first
+                wake_time = min(deadline, print_deadline.next_time)
+                if check_condition:
+                    wake_time = min(wake_time, next_poll)
+                if capture_deadline is not None:
+                    wake_time = min(wake_time, capture_deadline.next_time)
+                if self.overrides.next_time is not None:
+                    wake_time = min(wake_time, self.overrides.next_time)
+
+                self.metrics.observe('condition_iteration_seconds', time.perf_counter() - iteration_start)
+                self.clock.wait(self.cov_event, timeout=wake_time - self.clock.monotonic())
+                current_time = self.clock.monotonic()
+        finally:
+            self.metrics.observe('condition_wait_seconds', time.perf_counter() - wait_start)
+            if cov_subscribed:
+                self.controller.unsubscribe_cov(point_name=output_variable_to_check)
         print("wait time condition met")
 
-    def evaluate_boolean_expression(self, operator, actual_value, expected_value):
-        if operator == ">" and actual_value > expected_value:
-            return True
-        elif operator == ">=" and actual_value >= expected_value:
-            return True
-        elif operator == "<" and actual_value < expected_value:
-            return True
-        elif operator == "<=" and actual_value <= expected_value:
-            return True
-        elif operator == "==" and actual_value == expected_value:
-            return True
-        else:
-            return False
+    def report_updates(self, updated):
+        '''
+        :param updated: dictionary of bacnet point name: value written by a ramp or periodic update
+        '''
+        self.value_cache.invalidate(points=updated)
+        for variable in sorted(updated):
+            print("Updating input %s to %f" % (self.registry.to_test(variable), updated[variable]))
+        if updated:
+            print()
 
     def get_current_variable_values(self, variable_list):
-        vals = {}
-        for var in variable_list:
-            vals[var] = self.controller.device[var].value
-        return vals
-
-    def assert_output(self, expected_op_dict, actual_output_dict, acceptable_bounds_dict):
-        for key in expected_op_dict:
-            expected_val = expected_op_dict[key]
-            actual_val = actual_output_dict[key]
-            error_bound = acceptable_bounds_dict[key]
-
-            if type(actual_val) == str:
-                if actual_val == 'inactive':
-                    actual_val = 0
-                else:
-                    actual_val = 1
-
-            if expected_val == "Any":
+        return self.value_cache.read_data(points_to_read=list(variable_list))
+
+    def assert_output(self, checks, actual_output_dict, stop_on_failure=True):
+        '''
+        :param checks: output checks of a step of the TestPlan
+        :param actual_output_dict: snapshot of bacnet point name: value of the outputs
+        :param stop_on_failure: return at the first failed check instead of checking all outputs
+        :return: True if all checks passed
+        '''
+        passed = True
+        step_results = self.results.setdefault(self.current_step, {})
+        for check in checks:
+            result = self.check_output(check=check, actual_output_dict=actual_output_dict)
+            step_results[result['variable']] = result
+            if result['passed']:
                 continue
-            elif type(expected_val) == str:
-                if "last" in expected_val:
-                    operator = expected_val.split('last')[0]
-                    variable = key
-                    expected_val = self.step_outputs[self.current_step - 1][variable]
-
-                    if self.evaluate_boolean_expression(operator=operator, actual_value=actual_val, expected_value=expected_val):
-                        continue
-                    else:
-                        var_name = self.point_properties.loc[self.point_properties.name == key].name_in_test.values[0]
-                        print("For variable %s [or %s], actual value = %f not %s expected value = %f"%(key, var_name, actual_val, operator, expected_val))
-                        return False
-                if expected_val.startswith("="):
-                    expression = expected_val[1:]
-                    expected_value = self.evaluate_expression(expression=expression)
-
-                    if abs(expected_value - actual_val) > error_bound:
-                        var_name = self.point_properties.loc[self.point_properties.name == key].name_in_test.values[0]
-                        print ("outside bounds for %s [or %s], actual value = %f, expected value = %f, bounds = %f" % (
-                        key, var_name, actual_val, expected_val, error_bound))
-                        return False
 
+            passed = False
+            self.failures.append(result)
+            if result['operator'] is not None:
+                print("For variable %s [or %s], actual value = %f not %s expected value = %f"%(result['point'], result['variable'], result['actual'], result['operator'], result['expected']))
             else:
-                if self.point_properties.loc[key].units_state == 'percent':
-                    actual_val = actual_val/100
-
-                if abs(expected_val - actual_val) > error_bound:
-                    var_name = self.point_properties.loc[self.point_properties.name == key].name_in_test.values[0]
-                    print ("outside bounds for %s [or %s], actual value = %f, expected value = %f, bounds = %f"%(key, var_name, actual_val, expected_val, error_bound))
-                    return False
-
-        return True
-
-    def evaluate_expression(self, expression):
-        if expression.startswith("="):
-            expression = expression[1:]
-
-        while expression.find(')') != -1:
-            e_loc = expression.find(')')
-            s_loc = expression[:e_loc].rfind('(')
-            op = self.get_value_from_expression(expression=expression[s_loc + 1:e_loc])
-            expression = expression.replace(expression[s_loc:e_loc + 1], str(op))
-        return self.get_value_from_expression(expression=expression)
-
-    def get_value_from_expression(self, expression):
-
-        operator_found = False
-        result = None
-        for operator in ['+', '-', '*', '/']:
-            if operator in expression:
-                operator_found = True
-                parts = expression.split(operator)
-                for part in parts:
-                    current_res = self.get_value_from_expression(expression=part)
-                    if result:
-                        if operator == '+':
-                            result = result + current_res
-                        elif operator == '-':
-                            result = result - current_res
-                        elif operator == '*':
-                            result = result * current_res
-                        elif operator == '/':
-                            result = result / current_res
-                    else:
-                        result = current_res
-                break
-        if operator_found:
-            return result
+                print ("outside bounds for %s [or %s], actual value = %f, expected value = %f, bounds = %f"%(result['point'], result['variable'], result['actual'], result['expected'], result['bound']))
+            if stop_on_failure:
+                return False
+
+        return passed
+
+    def check_output(self, check, actual_output_dict):
+        '''
+        :return: dictionary with the step, variable, point, expected and actual values, bound, operator and passed
+        '''
+        key = check.point
+        actual_val = to_number(actual_output_dict[key])
+        result = {'step': self.current_step, 'variable': self.registry.to_test(key), 'point': key, 'operator': None, 'bound': None}
+
+        if isinstance(check, LastCheck):
+            expected_val = to_number(self.step_outputs[self.current_step - 1][key])
+            result['operator'] = check.operator
+            passed = compare(check.operator, actual_val, expected_val)
+        elif isinstance(check, ExpressionCheck):
+            expected_val = self.evaluate_expression(expression=check.expression, values=actual_output_dict)
+            result['bound'] = check.bound
+            passed = abs(expected_val - actual_val) <= check.bound
         else:
-            names_df = self.point_properties.loc[self.point_properties.name_in_test == expression]
-            if not names_df.empty:
-                var_name = names_df.name.values[0]
-                return self.controller.device[var_name].value
-            else:
-                try:
-                    float_value = float(expression)
-                except Exception as e:
-                    raise Exception("cannot find variable %s"%expression)
-                return float_value
+            actual_val = self.registry.get(key).normalize(actual_val)
+            expected_val = check.expected
+            result['bound'] = check.bound
+            passed = abs(expected_val - actual_val) <= check.bound
+
+        result.update({'expected': expected_val, 'actual': actual_val, 'passed': bool(passed)})
+        return result
+
+    def evaluate_expression(self, expression, values=None):
+        '''
+        Evaluate a test script expression
+        :param expression: compiled Expression, or expression string with or without the leading "="
+        :param values: optional snapshot of bacnet point name: value; variables missing from it are read in one request
+        :return: value of the expression
+        '''
+        if isinstance(expression, Expression):
+            compiled = expression
+        else:
+            compiled = self.compile_expression(expression=expression)
+        missing = [var for var in compiled.variables if values is None or var not in values]
+        if missing:
+            values = dict(values or {})
+            values.update(self.value_cache.read_data(points_to_read=missing))
+        with Timer(self.metrics, 'expression_seconds'):
+            return compiled.evaluate(values)
 
 
 if __name__ == "__main__":
-    test = Test()
-
     parser = argparse.ArgumentParser()
     parser.add_argument("--reset", help="reset point values to first stage", action='store_true')
+    parser.add_argument("--relinquish", help="release all inputs of the test script", action='store_true')
     parser.add_argument("--output", help="print point values", action='store_true')
     parser.add_argument("--csv", help="save outputs to csv", action='store_true')
-    parser.add_argument("--name", help="test name", default=time.strftime("%Y%m%dT%H%M%S"))
+    parser.add_argument("--name", help="test name, the current time by default")
+    parser.add_argument("--resume", help="continue the test --name after its last completed step", action='store_true')
+    parser.add_argument("--refresh-cache", help="discover the device again instead of using the cached points", action='store_true')
+    parser.add_argument("--continue-on-failure", help="run all steps and save the results of every check", action='store_true')
 
     args = parser.parse_args()
+    if args.resume and not args.name:
+        parser.error("--resume needs the --name of the interrupted test")
+
+    test = Test(refresh_cache=args.refresh_cache)
     reset = args.reset
     output = args.output
     to_csv = args.csv
-    name = args.name
+    name = args.name or time.strftime("%Y%m%dT%H%M%S")
 
     print(to_csv)
     print(name)
 
     if reset:
-        print("resetting points")
-        test.set_values(variable_value_dict=test.ip.iloc[1].to_dict())
-        points = test.read_points()
-        cool_loop_output = points['CoolLoopOut']
-
-        while cool_loop_output != 0:
-            print("waiting for cooling loop output to drop to 0, current value = %f"%cool_loop_output)
-            time.sleep(3)
-            points = test.read_points()
-            cool_loop_output = points['CoolLoopOut']
-
-        print()
+        test.reset()
         test.print_points()
+    elif args.relinquish:
+        results = test.relinquish()
+        for point in sorted(results):
+            print("%s: %s" % (test.registry.to_test(point), "relinquished" if results[point] else "failed"))
     elif output:
         print("printing values")
         test.print_points()
     else:
         print("starting test; Current values=")
         test.print_points()
-        test.start_test(to_csv=to_csv, name=name)
+        test.start_test(to_csv=to_csv, name=name, resume=args.resume, continue_on_failure=args.continue_on_failure or None)
 
@@ -0,0 +1,251 @@
+from collections import namedtuple
+import re
+
+# input actions; start / end of ramps are numbers or Expression objects evaluated when the step starts
+ConstantInput = namedtuple('ConstantInput', ['point', 'value'])
+ExpressionInput = namedtuple('ExpressionInput', ['point', 'expression'])
+RampInput = namedtuple('RampInput', ['point', 'start', 'end', 'rate', 'period'])
+PeriodicInput = namedtuple('PeriodicInput', ['point', 'expression', 'period'])
+
+# wait up to clk_time seconds, or until "variable operator value" holds if variable is not None
+Condition = namedtuple('Condition', ['clk_time', 'variable', 'operator', 'value'])
+
+# output checks
+ValueCheck = namedtuple('ValueCheck', ['point', 'expected', 'bound'])
+ExpressionCheck = namedtuple('ExpressionCheck', ['point', 'expression', 'bound'])
+LastCheck = namedtuple('LastCheck', ['point', 'operator'])
+
+# points a step depends on: the variables of its input expressions, read once when the step starts, and all points it
+# uses, i.e. also the condition variable, the outputs to check, the variables of their expressions and the written inputs
+Dependencies = namedtuple('Dependencies', ['inputs', 'all'])
+
+Step = namedtuple('Step', ['number', 'inputs', 'condition', 'outputs', 'dependencies'])
+
+OPERATOR_PATTERN = re.compile(r"\A(>=|<=|==|>|<)")
+ACTIVE_VALUES = ['open', 'present', 'on']
+INACTIVE_VALUES = ['closed', 'absent', 'off']
+
+
+class TestPlanError(Exception):
+    pass
+
+
+def is_empty(value):
+    # empty spreadsheet cells are NaN
+    return value is None or (type(value) == float and value != value)
+
+
+class TestPlan:
+    '''
+    Test script compiled into an immutable tuple of steps with typed input actions, a parsed condition
+    and typed output checks. All cells are validated when the plan is built, so a malformed cell fails at load time.
+    '''
+    DEFAULT_RAMP_PERIOD = 10
+    DEFAULT_PERIOD = 10
+
+    def __init__(self, ip, cond, op, compile_expression):
+        '''
+        :param ip: inputs DataFrame from Test.format_excel_df, one row per step, columns are bacnet names
+        :param cond: conditions DataFrame from Test.format_excel_df
+        :param op: outputs DataFrame from Test.format_excel_df, with the acceptable_bounds row
+        :param compile_expression: function compiling an expression string into an Expression
+        '''
+        self.compile_expression = compile_expression
+        self.input_points = tuple(ip.columns)
+        self.output_points = tuple(op.columns)
+        bounds = op.loc['acceptable_bounds'].to_dict()
+
+        steps = []
+        errors = []
+        for i in range(1, ip.shape[0]):
+            try:
+                inputs = self.parse_inputs(ip.iloc[i].to_dict())
+                condition = self.parse_condition(cond.iloc[i])
+                outputs = self.parse_outputs(op.iloc[i].to_dict(), bounds)
+                steps.append(Step(number=i, inputs=inputs, condition=condition, outputs=outputs,
+                                  dependencies=self.get_dependencies(inputs, condition, outputs)))
+            except TestPlanError as e:
+                errors.append("step %d: %s" % (i, e))
+        if errors:
+            raise TestPlanError("invalid test script\n" + "\n".join(errors))
+        self.steps = tuple(steps)
+
+    @classmethod
+    def from_steps(cls, steps, input_points, output_points, compile_expression):
+        '''
+        TestPlan of already compiled steps, e.g. loaded by PlanCache
+        '''
+        plan = cls.__new__(cls)
+        plan.compile_expression = compile_expression
+        plan.input_points = input_points
+        plan.output_points = output_points
+        plan.steps = tuple(steps)
+        return plan
+
+    def __len__(self):
+        return len(self.steps)
+
+    def compile(self, expression, point):
+        try:
+            return self.compile_expression(expression)
+        except Exception as e:
+            raise TestPlanError("variable %s: %s" % (point, e))
+
+    def parse_number_or_expression(self, param, point):
+        if param.startswith("="):
+            return self.compile(param, point)
+        try:
+            return float(param)
+        except ValueError:
+            raise TestPlanError("variable %s: invalid parameter %s" % (point, param))
+
+    def parse_inputs(self, values):
+        inputs = []
+        for point in values:
+            val = values[point]
+            if is_empty(val):
+                continue
+            if type(val) != str:
+                inputs.append(ConstantInput(point=point, value=val))
+                continue
+
+            # remove all whitespaces
+            val = val.replace(" ", "")
+            if val.startswith("ramp("):
+                inputs.append(self.parse_ramp(val, point))
+            elif val.startswith("periodic("):
+                inputs.append(self.parse_periodic(val, point))
+            elif val.startswith("="):
+                inputs.append(ExpressionInput(point=point, expression=self.compile(val, point)))
+            elif val.lower() in ACTIVE_VALUES:
+                inputs.append(ConstantInput(point=point, value='active'))
+            elif val.lower() in INACTIVE_VALUES:
+                inputs.append(ConstantInput(point=point, value='inactive'))
+            else:
+                inputs.append(ConstantInput(point=point, value=val))
+        return tuple(inputs)
+
+    def get_parameters(self, val, function, point):
+        if not val.endswith(")"):
+            raise TestPlanError("variable %s: missing ')' in %s" % (point, val))
+        return val[len(function) + 1:-1].split(";")
+
+    def parse_ramp(self, val, point):
+        params = self.get_parameters(val, "ramp", point)
+        if len(params) not in (3, 4):
+            raise TestPlanError("variable %s: ramp needs start, end, rate per minute and an optional period, got %s" % (point, val))
+
+        start = self.parse_number_or_expression(params[0], point)
+        end = self.parse_number_or_expression(params[1], point)
+        try:
+            # convert ramp rate to value per second
+            rate = float(params[2]) / 60.0
+            period = float(params[3]) if len(params) == 4 else self.DEFAULT_RAMP_PERIOD
+        except ValueError:
+            raise TestPlanError("variable %s: rate and period of %s must be numbers" % (point, val))
+        if period <= 0:
+            raise TestPlanError("variable %s: ramp period must be positive in %s" % (point, val))
+        return RampInput(point=point, start=start, end=end, rate=rate, period=period)
+
+    def parse_periodic(self, val, point):
+        params = self.get_parameters(val, "periodic", point)
+        if len(params) not in (1, 2) or not params[0].startswith("="):
+            raise TestPlanError("variable %s: periodic needs an expression and an optional period, got %s" % (point, val))
+
+        expression = self.compile(params[0], point)
+        try:
+            period = int(float(params[1])) if len(params) == 2 else self.DEFAULT_PERIOD
+        except ValueError:
+            raise TestPlanError("variable %s: period of %s must be a number" % (point, val))
+        if period <= 0:
+            raise TestPlanError("variable %s: period must be positive in %s" % (point, val))
+        return PeriodicInput(point=point, expression=expression, period=period)
+
+    def parse_condition(self, condition):
+        clk_time = condition['ClkTime']
+        if is_empty(clk_time):
+            raise TestPlanError("missing ClkTime")
+
+        if condition['or'] != 1:
+            return Condition(clk_time=float(clk_time), variable=None, operator=None, value=None)
+
+        variable = condition['VariableName']
+        value = condition['VariableValue']
+        if type(value) == str:
+            value = value.replace(" ", "")
+            operator = OPERATOR_PATTERN.findall(value)
+            if len(operator) != 1:
+                raise TestPlanError("invalid condition value %s for variable %s" % (value, variable))
+            operator = operator[0]
+
+            value = value[len(operator):]
+            try:
+                if value.endswith("%"):
+                    value = float(value[:-1])/100
+                else:
+                    value = float(value)
+            except ValueError:
+                raise TestPlanError("invalid condition value %s for variable %s" % (condition['VariableValue'], variable))
+        elif is_empty(value):
+            raise TestPlanError("missing condition value for variable %s" % variable)
+        else:
+            operator = ">="
+        return Condition(clk_time=float(clk_time), variable=variable, operator=operator, value=value)
+
+    def get_bound(self, bounds, point):
+        bound = bounds.get(point)
+        try:
+            bound = float(bound)
+        except (TypeError, ValueError):
+            bound = None
+        if bound is None or bound != bound:
+            raise TestPlanError("variable %s: missing acceptable bound" % point)
+        return bound
+
+    def get_dependencies(self, inputs, condition, outputs):
+        input_variables = []
+        for action in inputs:
+            if isinstance(action, RampInput):
+                expressions = [param for param in (action.start, action.end) if not isinstance(param, float)]
+            elif isinstance(action, (ExpressionInput, PeriodicInput)):
+                expressions = [action.expression]
+            else:
+                expressions = []
+            for expression in expressions:
+                input_variables.extend(expression.variables)
+
+        output_variables = []
+        for check in outputs:
+            output_variables.append(check.point)
+            if isinstance(check, ExpressionCheck):
+                output_variables.extend(check.expression.variables)
+
+        condition_variables = [condition.variable] if condition.variable is not None else []
+        all_variables = condition_variables + input_variables + output_variables + [action.point for action in inputs]
+        return Dependencies(inputs=tuple(dict.fromkeys(input_variables)), all=tuple(sorted(set(all_variables))))
+
+    def parse_outputs(self, values, bounds):
+        outputs = []
+        for point in values:
+            expected = values[point]
+            if is_empty(expected) or expected == "Any":
+                continue
+            if type(expected) != str:
+                outputs.append(ValueCheck(point=point, expected=expected, bound=self.get_bound(bounds, point)))
+                continue
+
+            expected = expected.replace(" ", "")
+            if "last" in expected:
+                operator = expected.split('last')[0]
+                if operator not in ('>', '>=', '<', '<=', '=='):
+                    raise TestPlanError("variable %s: invalid comparison %s" % (point, expected))
+                outputs.append(LastCheck(point=point, operator=operator))
+            elif expected.startswith("="):
+                outputs.append(ExpressionCheck(point=point, expression=self.compile(expected, point),
+                                               bound=self.get_bound(bounds, point)))
+            elif expected.lower() in ACTIVE_VALUES or expected.lower() in INACTIVE_VALUES:
+                outputs.append(ValueCheck(point=point, expected=1 if expected.lower() in ACTIVE_VALUES else 0,
+                                          bound=self.get_bound(bounds, point)))
+            else:
+                raise TestPlanError("variable %s: invalid expected value %s" % (point, expected))
+        return tuple(outputs)
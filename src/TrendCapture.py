@@ -0,0 +1,133 @@
+import glob
+import numpy as np
+from src.PointRegistry import to_number
+
+
+def to_float(value):
+    try:
+        return float(to_number(value))
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class TrendCapture:
+    '''
+    High-rate capture of all mapped points into a preallocated ring buffer (one row per sample, one column per point).
+    The buffer keeps the most recent samples in memory and is spilled to numbered .npz chunk files, so memory use
+    stays bounded on multi-day runs while every sample is kept on disk. Binary values are stored as 1 / 0.
+    '''
+    def __init__(self, points, read_data, clock, rate=1.0, buffer_size=3600, chunk_size=600, file_prefix=None, append=False):
+        '''
+        :param points: list of bacnet point names to capture
+        :param read_data: function reading a list of points in one batch, e.g. Device.read_data
+        :param clock: Clock giving the sample timestamps
+        :param rate: samples per second
+        :param buffer_size: number of samples kept in memory
+        :param chunk_size: number of samples per chunk file, at most buffer_size
+        :param file_prefix: chunk files are <file_prefix>_<n>.npz, nothing is written to disk if None
+        :param append: number the chunks after the existing chunk files of file_prefix, e.g. of a resumed test,
+                       instead of overwriting them
+        '''
+        self.points = list(points)
+        self.columns = {point: i for i, point in enumerate(self.points)}
+        self.read_data = read_data
+        self.clock = clock
+        self.period = 1.0 / rate
+        self.buffer_size = buffer_size
+        self.chunk_size = min(chunk_size, buffer_size)
+        self.file_prefix = file_prefix
+
+        self.timestamps = np.full(buffer_size, np.nan)
+        self.values = np.full((buffer_size, len(self.points)), np.nan)
+        # total number of samples taken, the next sample goes to row count % buffer_size
+        self.count = 0
+        self.spilled = 0
+        self.chunk_index = self.get_next_chunk_index() if append and file_prefix is not None else 0
+
+    def sample(self):
+        '''
+        Read all points in one batch and store them
+        :return: the snapshot of bacnet point name: value that was read
+        '''
+        snapshot = self.read_data(points_to_read=self.points)
+        row = self.count % self.buffer_size
+        self.timestamps[row] = self.clock.time()
+        self.values[row] = [to_float(snapshot[point]) for point in self.points]
+        self.count += 1
+
+        if self.count - self.spilled >= self.chunk_size:
+            self.spill()
+        return snapshot
+
+    def get_next_chunk_index(self):
+        indexes = [int(file[len(self.file_prefix) + 1:-len(".npz")]) for file in glob.glob(self.file_prefix + "_*.npz")
+                   if file[len(self.file_prefix) + 1:-len(".npz")].isdigit()]
+        return max(indexes) + 1 if indexes else 0
+
+    def get_rows(self, start, end):
+        # rows of the samples with sample numbers start..end-1, all still in memory
+        return np.arange(start, end) % self.buffer_size
+
+    def spill(self):
+        '''
+        Write the samples not yet on disk to the next chunk file
+        '''
+        if self.file_prefix is None or self.count == self.spilled:
+            return
+        # samples overwritten before being spilled are lost; cannot happen while chunk_size <= buffer_size
+        start = max(self.spilled, self.count - self.buffer_size)
+        rows = self.get_rows(start, self.count)
+        np.savez(self.file_prefix + "_%04d.npz" % self.chunk_index, timestamps=self.timestamps[rows],
+                 values=self.values[rows], points=np.array(self.points))
+        self.chunk_index += 1
+        self.spilled = self.count
+
+    def close(self):
+        self.spill()
+
+    def window(self, start_time=None, end_time=None):
+        '''
+        Samples in memory between two timestamps
+        :return: (timestamps, values) arrays in time order, values has one column per point of self.points
+        '''
+        first = max(0, self.count - self.buffer_size)
+        rows = self.get_rows(first, self.count)
+        timestamps = self.timestamps[rows]
+        mask = np.ones(len(rows), dtype=bool)
+        if start_time is not None:
+            mask &= timestamps >= start_time
+        if end_time is not None:
+            mask &= timestamps <= end_time
+        return timestamps[mask], self.values[rows][mask]
+
+    def value_at(self, timestamp):
+        '''
+        :return: dictionary of bacnet point name: value of the last sample at or before timestamp, None if there is none
+        '''
+        timestamps, values = self.window(end_time=timestamp)
+        if len(timestamps) == 0:
+            return None
+        return dict(zip(self.points, values[-1]))
+
+    def history(self, point, start_time=None, end_time=None):
+        timestamps, values = self.window(start_time=start_time, end_time=end_time)
+        return timestamps, values[:, self.columns[point]]
+
+
+def load_capture(file_prefix):
+    '''
+    Load all chunk files of a capture
+    :return: (timestamps, values, points)
+    '''
+    files = sorted(glob.glob(file_prefix + "_*.npz"))
+    if not files:
+        raise Exception("no capture files found for %s" % file_prefix)
+    timestamps = []
+    values = []
+    points = None
+    for file in files:
+        with np.load(file) as chunk:
+            timestamps.append(chunk['timestamps'])
+            values.append(chunk['values'])
+            points = list(chunk['points'])
+    return np.concatenate(timestamps), np.concatenate(values), points
@@ -0,0 +1,154 @@
+import csv
+import os
+import queue
+import threading
+import time
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+class TrendLogger:
+    '''
+    Long-lived trend writer. Rows are put on a bounded queue and written by a background thread in batches,
+    so logging never waits on the disk, and the file is opened once for the whole run.
+    The column schema is fixed when the logger is created. Writes csv, or parquet / arrow files if pyarrow is installed.
+    '''
+    FILE_FORMATS = ('csv', 'parquet', 'arrow')
+    ARROW_TYPES = {'float': 'float64', 'int': 'int64', 'str': 'string'}
+
+    def __init__(self, filename, columns, column_types=None, file_format='csv', queue_size=1000, batch_size=100,
+                 flush_interval=5.0):
+        '''
+        :param filename: file to write; csv files are appended to if their header matches the columns, parquet and arrow
+                         files cannot be appended to and the rows go to the next free <name>_part<n> file instead
+        :param columns: list of column names
+        :param column_types: list of 'float', 'int' or 'str' per column, used for parquet and arrow files; all 'str' by default
+        :param file_format: csv, parquet or arrow
+        :param queue_size: maximum number of rows waiting to be written, log() blocks when the queue is full
+        :param batch_size: number of rows written at once
+        :param flush_interval: maximum seconds a row waits before being written
+        '''
+        if file_format not in self.FILE_FORMATS:
+            raise Exception("unknown trend file format %s" % file_format)
+        if file_format != 'csv' and pa is None:
+            raise Exception("pyarrow is required to write %s trend files" % file_format)
+
+        self.filename = filename
+        self.columns = list(columns)
+        self.column_types = list(column_types) if column_types is not None else ['str'] * len(self.columns)
+        self.file_format = file_format
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.rows_written = 0
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.open_file()
+
+        self.thread = threading.Thread(target=self.run, name="TrendLogger %s" % os.path.basename(filename), daemon=True)
+        self.thread.start()
+
+    def open_file(self):
+        if self.file_format == 'csv':
+            if os.path.exists(self.filename) and os.path.getsize(self.filename) > 0:
+                with open(self.filename, "r", newline='') as fp:
+                    header = next(csv.reader(fp))
+                if header != self.columns:
+                    raise Exception("columns of existing trend file %s do not match the points of this test" % self.filename)
+                self.fp = open(self.filename, "a", newline='')
+                self.writer = csv.writer(self.fp)
+            else:
+                self.fp = open(self.filename, "w", newline='')
+                self.writer = csv.writer(self.fp)
+                self.writer.writerow(self.columns)
+                self.fp.flush()
+        else:
+            if os.path.exists(self.filename):
+                self.filename = self.get_part_filename()
+                print("trend file exists, e.g. of a resumed test, writing to %s" % self.filename)
+            self.schema = pa.schema([(column, self.ARROW_TYPES[column_type]) for column, column_type in zip(self.columns, self.column_types)])
+            if self.file_format == 'parquet':
+                self.writer = pq.ParquetWriter(self.filename, self.schema)
+            else:
+                self.writer = pa.ipc.new_file(self.filename, self.schema)
+
+    def get_part_filename(self):
+        root, extension = os.path.splitext(self.filename)
+        part = 1
+        while os.path.exists("%s_part%d%s" % (root, part, extension)):
+            part += 1
+        return "%s_part%d%s" % (root, part, extension)
+
+    def log(self, row):
+        '''
+        :param row: dictionary of column: value or list of values in column order; missing columns are left empty
+        '''
+        if self.error is not None:
+            raise Exception("trend logger %s stopped: %s" % (self.filename, self.error))
+        if isinstance(row, dict):
+            row = [row.get(column) for column in self.columns]
+        self.queue.put(row)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        batch = []
+        last_flush = time.monotonic()
+        closing = False
+        while not closing:
+            timeout = max(0, self.flush_interval - (time.monotonic() - last_flush))
+            try:
+                row = self.queue.get(timeout=timeout)
+                if row is None:
+                    closing = True
+                else:
+                    batch.append(row)
+            except queue.Empty:
+                pass
+
+            if batch and (closing or len(batch) >= self.batch_size or time.monotonic() - last_flush >= self.flush_interval):
+                self.write_batch(batch)
+                batch = []
+            if not batch:
+                last_flush = time.monotonic()
+
+        try:
+            if self.file_format == 'csv':
+                self.fp.close()
+            else:
+                self.writer.close()
+        except Exception as e:
+            self.error = e
+
+    def write_batch(self, batch):
+        try:
+            if self.file_format == 'csv':
+                self.writer.writerows(batch)
+                self.fp.flush()
+            else:
+                arrays = [[self.convert(row[i], column_type) for row in batch] for i, column_type in enumerate(self.column_types)]
+                table = pa.Table.from_arrays([pa.array(values, type=self.schema.field(i).type) for i, values in enumerate(arrays)],
+                                             schema=self.schema)
+                self.writer.write_table(table)
+            self.rows_written += len(batch)
+        except Exception as e:
+            print("error writing trend file %s: %s" % (self.filename, e))
+            self.error = e
+
+    def convert(self, value, column_type):
+        if value is None:
+            return None
+        try:
+            if column_type == 'float':
+                return float(value)
+            elif column_type == 'int':
+                return int(value)
+        except (TypeError, ValueError):
+            return None
+        return str(value)
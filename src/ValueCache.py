@@ -0,0 +1,71 @@
+import threading
+
+
+class ValueCache:
+    '''
+    Point values read from the device, served again to reads within ttl seconds, so that the condition check,
+    ramp / periodic expressions and logs of one iteration of the test loop read each point from the device only once.
+    Points not in the cache are read together in one batch.
+    '''
+    def __init__(self, read_data, clock, ttl=0.5):
+        '''
+        :param read_data: function reading a list of points in one batch, e.g. Device.read_data
+        :param clock: Clock of the test, the age of the values is measured on its monotonic clock
+        :param ttl: seconds a value is served from the cache, 0 to always read from the device
+        '''
+        self.read_data_fn = read_data
+        self.clock = clock
+        self.ttl = ttl
+        # bacnet point name: (value, monotonic time it was read)
+        self.values = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def read_data(self, points_to_read):
+        '''
+        :param points_to_read: list of point names
+        :return: dictionary of pointname: value, read at most ttl seconds ago
+        '''
+        now = self.clock.monotonic()
+        values = {}
+        missing = []
+        with self.lock:
+            for point in dict.fromkeys(points_to_read):
+                cached = self.values.get(point)
+                if cached is not None and now - cached[1] <= self.ttl:
+                    values[point] = cached[0]
+                else:
+                    missing.append(point)
+            self.hits += len(values)
+
+        if missing:
+            values.update(self.refresh(missing))
+        return values
+
+    def refresh(self, points_to_read):
+        '''
+        Read points from the device, whatever their age in the cache
+        '''
+        values = self.read_data_fn(points_to_read=points_to_read)
+        now = self.clock.monotonic()
+        with self.lock:
+            self.misses += len(points_to_read)
+            for point, value in values.items():
+                self.values[point] = (value, now)
+        return values
+
+    def invalidate(self, points=None):
+        '''
+        Forget cached values, e.g. of the points just written
+        '''
+        with self.lock:
+            if points is None:
+                self.values = {}
+            else:
+                for point in points:
+                    self.values.pop(point, None)
+
+    def get_counters(self):
+        return {'hits': self.hits, 'misses': self.misses}